@@ -0,0 +1,46 @@
+import time
+
+# Admission control.  A room only ever does a fixed, small amount of work to decide
+# whether to take on more: a count of sessions to compare against a limit, and token
+# buckets that refill with the time since they were last looked at.  Anything over a
+# limit is turned away with a "server busy" reply rather than queued, so a player
+# flooding commands or a storm of connections can't push up everyone else's latency.
+
+
+# A token bucket holding up to burst tokens and refilling at rate tokens a second.
+# Something costing more than the bucket can hold is let through whenever the bucket is
+# full, leaving it in debt, so it is slowed down rather than refused forever.
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    # Whether there are tokens enough for something costing cost.
+
+    def has(self, cost=1):
+        self.refill()
+        return self.tokens >= min(cost, self.burst)
+
+    # Take tokens for something costing cost, if there are enough.  Returns True if taken.
+
+    def take(self, cost=1):
+        if not self.has(cost):
+            return False
+        self.tokens -= cost
+        return True
+
+    # Take tokens for something that has to happen anyway, going into debt if need be.
+
+    def spend(self, cost):
+        self.refill()
+        self.tokens -= cost
@@ -0,0 +1,382 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import deque
+from urllib.parse import urlparse
+try:
+    import resource
+except ImportError:
+    resource = None
+from protocol import frame_message, unframe_messages, KIND_REPLY, KIND_BINARY_COMMAND, KIND_BINARY_REPLY, \
+    KIND_BINARY_EVENT, KIND_HEARTBEAT, SERVER_BUSY
+from binary import NameTable, encode_command, decode_reply, decode_event
+
+# Headless load generator for room.py.  Runs thousands of simulated players in one
+# process, all speaking the same protocol as player.py, and reports throughput,
+# latency percentiles and connection setup rate.  Results can be saved as a baseline
+# and later runs compared against it so regressions show up.
+
+# Commands the simulated players issue, and how often, unless told otherwise.
+
+DEFAULT_MIX = 'look=40,take=15,drop=15,say=20,move=5,exit=5'
+
+# Item the players pass back and forth with take and drop.
+
+BENCH_ITEM = 'benchtoken'
+
+# Answer to the room's heartbeats.
+
+HEARTBEAT_FRAME = frame_message(b'', KIND_HEARTBEAT)
+
+# Percentiles reported for every kind of command.
+
+PERCENTILES = (('p50', 0.50), ('p99', 0.99), ('p999', 0.999))
+
+# Raised when the room hangs up on a simulated player.
+
+class RoomClosed(Exception):
+    pass
+
+
+# One simulated player.
+
+class Bot:
+    __slots__ = ('name', 'room', 'binary', 'reader', 'writer', 'buffer', 'frames', 'exits', 'sent_names',
+                 'received_names', 'version')
+
+    def __init__(self, name, room, binary):
+        self.name = name
+        self.room = room
+        # Whether the bot talks to the room in binary, and the names each side has sent.
+        self.binary = binary
+        self.sent_names = None
+        self.received_names = None
+        self.reader = None
+        self.writer = None
+        self.buffer = bytearray()
+        # Frames received but not looked at yet.
+        self.frames = deque()
+        # Directions out of the room the bot is in, read from its summaries.
+        self.exits = []
+        # Version of the room the bot last asked for changes to, for "delta" in the mix.
+        self.version = None
+
+
+# Everything measured during a run.
+
+class Results:
+
+    def __init__(self):
+        self.latencies = {}
+        self.connect_times = []
+        self.events = 0
+        self.errors = 0
+        # Commands the room turned away as too busy.
+        self.busy = 0
+
+    def record(self, command, seconds):
+        self.latencies.setdefault(command, []).append(seconds)
+
+
+# Parse a mix such as "look=40,say=20" into parallel lists of commands and weights.
+
+def parse_mix(text):
+    commands = []
+    weights = []
+    for part in text.split(','):
+        command, weight = part.split('=')
+        commands.append(command.strip())
+        weights.append(float(weight))
+    return commands, weights
+
+
+# Wait for the room's reply to a command, counting any events that arrive first.  Binary
+# events have to be read too, as they may name someone for the first time.
+
+async def read_reply(bot, results):
+    while True:
+        while bot.frames:
+            kind, payload = bot.frames.popleft()
+            if kind == KIND_HEARTBEAT:
+                bot.writer.write(HEARTBEAT_FRAME)
+                continue
+            if kind == KIND_REPLY:
+                return payload.decode()
+            if kind == KIND_BINARY_REPLY:
+                return decode_reply(payload, bot.received_names)
+            if kind == KIND_BINARY_EVENT:
+                decode_event(payload, bot.received_names)
+            results.events += 1
+        data = await bot.reader.read(65536)
+        if not data:
+            raise RoomClosed()
+        bot.buffer += data
+        bot.frames.extend(unframe_messages(bot.buffer))
+
+
+# Note the exits mentioned in a room summary so the bot can wander.  Replies that aren't
+# summaries, such as directions to a room on another server, leave the bot where it is.
+
+def read_exits(bot, summary):
+    if '\n\n' not in summary:
+        return
+    exits = []
+    for line in summary.split('\n'):
+        if line.startswith('A doorway leads away from the room to the ') or \
+                line.startswith('A hatch leads out of the room going '):
+            exits.append(line.rstrip('.').split()[-1])
+    bot.exits = exits
+
+
+# Connect a bot and join the room, timing how long it takes.
+
+async def connect_bot(bot, host, port, results):
+    start = time.perf_counter()
+    bot.reader, bot.writer = await asyncio.open_connection(host, port)
+    bot.buffer.clear()
+    bot.frames.clear()
+    command = 'join {}'.format(bot.name)
+    if bot.room is not None:
+        command += ' {}'.format(bot.room)
+    if bot.binary:
+        command += ' +binary'
+        bot.sent_names = NameTable()
+        bot.received_names = []
+    bot.writer.write(frame_message(command))
+    bot.version = None
+    read_exits(bot, await read_reply(bot, results))
+    results.connect_times.append(time.perf_counter() - start)
+
+
+# The text of the next command for a bot to send.
+
+def make_command(bot, command):
+    if command == 'take':
+        return 'take ' + BENCH_ITEM
+    elif command == 'drop':
+        return 'drop ' + BENCH_ITEM
+    elif command == 'say':
+        return 'say benchmark chatter from ' + bot.name
+    elif command == 'emote':
+        return 'emote waves at everyone'
+    elif command == 'shout':
+        return 'shout benchmark shouting from ' + bot.name
+    elif command == 'delta':
+        return 'look since' if bot.version is None else 'look since {}'.format(bot.version)
+    elif command == 'move':
+        return random.choice(bot.exits) if bot.exits else 'look'
+    return command
+
+
+# Frame a command the way the bot talks to the room.
+
+def frame_command(bot, text):
+    if bot.binary:
+        return frame_message(encode_command(bot.sent_names, text), KIND_BINARY_COMMAND)
+    return frame_message(text)
+
+
+# Keep one bot busy until the deadline, with a batch of commands in flight at a time.
+
+async def run_bot(bot, host, port, mix, pipeline, deadline, results):
+    commands, weights = mix
+    while time.perf_counter() < deadline:
+        batch = random.choices(commands, weights, k=pipeline)
+        try:
+            if 'exit' in batch:
+                start = time.perf_counter()
+                bot.writer.write(frame_command(bot, 'exit'))
+                await read_reply(bot, results)
+                results.record('exit', time.perf_counter() - start)
+                bot.writer.close()
+                await connect_bot(bot, host, port, results)
+                continue
+            texts = [make_command(bot, command) for command in batch]
+            start = time.perf_counter()
+            bot.writer.write(b''.join(frame_command(bot, text) for text in texts))
+            for command in batch:
+                reply = await read_reply(bot, results)
+                results.record(command, time.perf_counter() - start)
+                if reply == SERVER_BUSY:
+                    results.busy += 1
+                if command == 'move':
+                    read_exits(bot, reply)
+                    bot.version = None
+                elif command == 'delta' and reply.startswith('Version '):
+                    bot.version = int(reply.split(None, 2)[1])
+        except (RoomClosed, ConnectionError):
+            results.errors += 1
+            try:
+                await connect_bot(bot, host, port, results)
+            except (RoomClosed, OSError):
+                return
+
+
+# Work out a percentile of a sorted list of timings.
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(fraction * len(timings)))]
+
+
+# Turn a list of timings into milliseconds at each reported percentile.
+
+def summarize_timings(timings):
+    timings = sorted(timings)
+    summary = {'count': len(timings)}
+    for label, fraction in PERCENTILES:
+        summary[label] = round(percentile(timings, fraction) * 1000, 3) if timings else None
+    return summary
+
+
+# Run the whole benchmark and return its results as a dictionary.
+
+async def run_benchmark(host, port, rooms, players, duration, mix, pipeline, concurrency, binary):
+    results = Results()
+    bots = [Bot('bot{}'.format(index), rooms[index % len(rooms)] if rooms else None, binary)
+            for index in range(players)]
+
+    # Bring every bot into the game, a limited number of connections at a time.
+    limit = asyncio.Semaphore(concurrency)
+
+    async def bring_in(bot):
+        async with limit:
+            await connect_bot(bot, host, port, results)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[bring_in(bot) for bot in bots])
+    setup = time.perf_counter() - start
+
+    # Then let them loose for the length of the run.
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*[run_bot(bot, host, port, mix, pipeline, deadline, results) for bot in bots])
+    elapsed = time.perf_counter() - start
+
+    for bot in bots:
+        if bot.writer is not None:
+            bot.writer.close()
+
+    everything = [seconds for timings in results.latencies.values() for seconds in timings]
+    return {
+        'players': players,
+        'duration': round(elapsed, 3),
+        'commands': len(everything),
+        'throughput': round(len(everything) / elapsed, 1),
+        'connect_rate': round(players / setup, 1),
+        'connect': summarize_timings(results.connect_times),
+        'latency': summarize_timings(everything),
+        'commands_by_type': {command: summarize_timings(timings)
+                             for command, timings in sorted(results.latencies.items())},
+        'events': results.events,
+        'errors': results.errors,
+        'busy': results.busy,
+    }
+
+
+# Print the results of a run for people to read.
+
+def print_results(results):
+    print('Players: {}  Commands: {}  Events received: {}  Errors: {}  Busy: {}'.format(
+        results['players'], results['commands'], results['events'], results['errors'], results.get('busy', 0)))
+    print('Throughput: {} commands/s  Connection setup: {} joins/s'.format(
+        results['throughput'], results['connect_rate']))
+    print('{:<10}{:>10}{:>12}{:>12}{:>12}'.format('command', 'count', 'p50 ms', 'p99 ms', 'p999 ms'))
+    rows = [('all', results['latency']), ('connect', results['connect'])]
+    rows += list(results['commands_by_type'].items())
+    for command, timings in rows:
+        print('{:<10}{:>10}{:>12}{:>12}{:>12}'.format(command, timings['count'], str(timings['p50']),
+                                                      str(timings['p99']), str(timings['p999'])))
+
+
+# Compare a run against a saved baseline.  Returns a list of regressions found.
+
+def compare_results(results, baseline, tolerance):
+    regressions = []
+    for key in ('throughput', 'connect_rate'):
+        if results[key] < baseline[key] * (1 - tolerance):
+            regressions.append('{} fell from {} to {}'.format(key, baseline[key], results[key]))
+    for label, fraction in PERCENTILES:
+        old = baseline['latency'][label]
+        new = results['latency'][label]
+        if old is not None and new is not None and new > old * (1 + tolerance):
+            regressions.append('{} latency rose from {} ms to {} ms'.format(label, old, new))
+    return regressions
+
+
+# Allow as many open sockets as the system will let us have.
+
+def raise_file_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# Our main function.
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a room server with simulated players.')
+    parser.add_argument("server", help="URL of the room in form of room://host:port")
+    parser.add_argument("--players", type=int, default=100, help="number of simulated players")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run for")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights of each command, as in look=40,say=20")
+    parser.add_argument("--pipeline", type=int, default=1, help="commands each player has in flight at once")
+    parser.add_argument("--rooms", help="comma separated rooms of a world host to spread players across")
+    parser.add_argument("--concurrency", type=int, default=200, help="connections to open at once")
+    parser.add_argument("--save-baseline", help="file to save the results to as a baseline")
+    parser.add_argument("--compare", help="baseline file to compare the results against")
+    parser.add_argument("--tolerance", type=float, default=10.0,
+                        help="percentage a result may be worse than the baseline before it's a regression")
+    parser.add_argument("--binary", action='store_true', help="have the players talk to the room in binary")
+    parser.add_argument("--json", action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    server_address = urlparse(args.server)
+    if (server_address.scheme != 'room') or (server_address.port is None) or (server_address.hostname is None):
+        print('Error:  Invalid server.  Enter a URL of the form:  room://host:port')
+        sys.exit(1)
+    rooms = args.rooms.split(',') if args.rooms else []
+    if not rooms and server_address.path.lstrip('/'):
+        rooms = [server_address.path.lstrip('/')]
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError:
+        print('Error:  Invalid mix.  Enter weights of the form:  look=40,say=20')
+        sys.exit(1)
+
+    raise_file_limit()
+    try:
+        results = asyncio.run(run_benchmark(server_address.hostname, server_address.port, rooms,
+                                            args.players, args.duration, mix, max(args.pipeline, 1),
+                                            args.concurrency, args.binary))
+    except (OSError, RoomClosed) as error:
+        print('Error: Could not run the benchmark: {}'.format(error or 'room closed the connection'))
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print('Baseline saved to {}'.format(args.save_baseline))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_results(results, baseline, args.tolerance / 100)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if regressions:
+            sys.exit(1)
+        print('No regressions against {}'.format(args.compare))
+
+
+if __name__ == '__main__':
+    main()
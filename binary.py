@@ -0,0 +1,300 @@
+from protocol import FrameError
+from itemstore import parse_item_counts, describe_items
+
+# Compact binary messages, for players who ask for them when they join with
+# "join <name> [room] +binary".  They travel in frames of their own kinds, so a player
+# can still send text commands and gets text replies to them.
+#
+# A binary message is an opcode byte followed by its fields.  Numbers are varints: seven
+# bits a byte, low bits first, with the top bit set on every byte but the last.  Text is a
+# varint length and then UTF-8, except as the last field of a message, where it simply
+# runs to the end.  Player and item names are interned: each side of a session numbers the
+# names it sends in the order it first sends them, so a name is spelt out once and is a
+# varint after that.  A name field is a varint which, with its low bit clear, is the number
+# of a name already sent, and with it set is the length of a new name that follows.
+
+# Commands.
+
+COMMAND_TEXT = 0
+COMMAND_LOOK = 1
+COMMAND_TAKE = 2
+COMMAND_DROP = 3
+COMMAND_SAY = 4
+COMMAND_MOVE = 5
+COMMAND_EXIT = 6
+COMMAND_EXITS = 7
+
+# Replies.
+
+REPLY_TEXT = 0
+REPLY_ITEMS = 1
+REPLY_EXIT = 2
+
+# Events.
+
+EVENT_TEXT = 0
+EVENT_ENTERED = 1
+EVENT_LEFT = 2
+EVENT_SAID = 3
+
+# What happened to each item in an items reply.
+
+ITEM_TAKEN = 0
+ITEM_DROPPED = 1
+ITEM_REFUSED = 2
+
+ITEM_VERBS = ('taken', 'dropped', 'cannot be taken in this room')
+
+# Directions by their number on the wire, and the number sent for leaving the server.
+
+DIRECTIONS = ('north', 'south', 'east', 'west', 'up', 'down')
+LEFT_SERVER = 255
+
+# Most names either side numbers in a session.  Names past this are always spelt out.
+
+MAX_NAMES = 4096
+
+# Opcodes of single byte commands, by the text command they stand for.
+
+SIMPLE_COMMANDS = {'look': COMMAND_LOOK, 'exit': COMMAND_EXIT, 'exits': COMMAND_EXITS}
+SIMPLE_TEXT = {opcode: text for text, opcode in SIMPLE_COMMANDS.items()}
+
+
+# The names one side of a session has sent, numbered in the order they were first sent.
+
+class NameTable:
+    __slots__ = ('ids',)
+
+    def __init__(self, names=()):
+        self.ids = {}
+        for name in names:
+            self.ids[name] = len(self.ids)
+
+    def names(self):
+        return list(self.ids)
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data) or shift > 35:
+            raise FrameError('Bad number in binary message')
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def write_text(out, text):
+    encoded = text.encode()
+    write_varint(out, len(encoded))
+    out += encoded
+
+
+def read_text(data, offset):
+    length, offset = read_varint(data, offset)
+    if offset + length > len(data):
+        raise FrameError('Text runs past the end of a binary message')
+    return bytes(data[offset:offset + length]).decode(errors='replace'), offset + length
+
+
+# Write a name, as its number if it's been sent before and spelt out otherwise.
+
+def write_name(out, table, name):
+    number = table.ids.get(name)
+    if number is not None:
+        write_varint(out, number << 1)
+        return
+    encoded = name.encode()
+    write_varint(out, (len(encoded) << 1) | 1)
+    out += encoded
+    if len(table.ids) < MAX_NAMES:
+        table.ids[name] = len(table.ids)
+
+
+# Read a name, given the list of names the other side has sent so far.
+
+def read_name(data, offset, names):
+    value, offset = read_varint(data, offset)
+    if not value & 1:
+        if value >> 1 >= len(names):
+            raise FrameError('Unknown name number {} in binary message'.format(value >> 1))
+        return names[value >> 1], offset
+    length = value >> 1
+    if offset + length > len(data):
+        raise FrameError('Name runs past the end of a binary message')
+    name = bytes(data[offset:offset + length]).decode(errors='replace')
+    if len(names) < MAX_NAMES:
+        names.append(name)
+    return name, offset + length
+
+
+# Encode a text command in binary, falling back on sending the text when it has no
+# binary form.
+
+def encode_command(table, command):
+    words = command.split()
+    if not words:
+        return bytes([COMMAND_TEXT]) + command.encode()
+    if command in SIMPLE_COMMANDS:
+        return bytes([SIMPLE_COMMANDS[command]])
+    if command.lower() in DIRECTIONS:
+        return bytes([COMMAND_MOVE, DIRECTIONS.index(command.lower())])
+    if words[0] == 'say':
+        return bytes([COMMAND_SAY]) + command[4:].encode()
+    if words[0] == 'take' or words[0] == 'drop':
+        if words[1:] == ['all'] and words[0] == 'take':
+            requests = []
+        else:
+            requests = parse_item_counts(words[1:])
+        if requests is not None and (words[0] == 'take' or all(count is not None for count, item in requests)):
+            out = bytearray([COMMAND_TAKE if words[0] == 'take' else COMMAND_DROP])
+            write_varint(out, len(requests))
+            for count, item in requests:
+                # A count of 0 means all of the item.
+                write_varint(out, count or 0)
+                write_name(out, table, item)
+            return bytes(out)
+    return bytes([COMMAND_TEXT]) + command.encode()
+
+
+# Decode a binary command back into the text command it stands for.
+
+def decode_command(data, names):
+    if not data:
+        raise FrameError('Empty binary message')
+    opcode = data[0]
+    if opcode == COMMAND_TEXT:
+        return bytes(data[1:]).decode(errors='replace')
+    if opcode in SIMPLE_TEXT:
+        return SIMPLE_TEXT[opcode]
+    if opcode == COMMAND_SAY:
+        return 'say ' + bytes(data[1:]).decode(errors='replace')
+    if opcode == COMMAND_MOVE:
+        if len(data) != 2 or data[1] >= len(DIRECTIONS):
+            raise FrameError('Bad direction in binary message')
+        return DIRECTIONS[data[1]]
+    if opcode == COMMAND_TAKE or opcode == COMMAND_DROP:
+        words = ['take' if opcode == COMMAND_TAKE else 'drop']
+        count, offset = read_varint(data, 1)
+        for index in range(count):
+            amount, offset = read_varint(data, offset)
+            item, offset = read_name(data, offset, names)
+            if amount == 0:
+                words.append('all')
+            elif amount != 1:
+                words.append(str(amount))
+            words.append(item)
+        if count == 0:
+            words.append('all')
+        return ' '.join(words)
+    raise FrameError('Unknown binary command {}'.format(opcode))
+
+
+# Replies and events the room sends.
+
+def encode_text(opcode, text):
+    if isinstance(text, str):
+        text = text.encode()
+    return bytes([opcode]) + text
+
+
+# An items reply, from a list of (what happened, count, item).
+
+def encode_items(table, results):
+    out = bytearray([REPLY_ITEMS])
+    write_varint(out, len(results))
+    for status, count, item in results:
+        out.append(status)
+        write_varint(out, count)
+        write_name(out, table, item)
+    return bytes(out)
+
+
+# A reply saying an exit leads to another server.
+
+def encode_exit(direction, hostname, port, room_name):
+    out = bytearray([REPLY_EXIT, DIRECTIONS.index(direction)])
+    write_varint(out, port)
+    write_text(out, hostname)
+    if room_name is not None:
+        out += room_name.encode()
+    return bytes(out)
+
+
+# An event about a player: entering, leaving (in a direction, or None for the server)
+# or saying something.
+
+def encode_event(table, opcode, player, detail=None):
+    out = bytearray([opcode])
+    write_name(out, table, player)
+    if opcode == EVENT_LEFT:
+        out.append(LEFT_SERVER if detail is None else DIRECTIONS.index(detail))
+    elif opcode == EVENT_SAID:
+        out += detail.encode()
+    return bytes(out)
+
+
+# Decode a binary reply into the text the room would have replied with.
+
+def decode_reply(data, names):
+    if not data:
+        raise FrameError('Empty binary message')
+    opcode = data[0]
+    if opcode == REPLY_TEXT:
+        return bytes(data[1:]).decode(errors='replace')
+    if opcode == REPLY_ITEMS:
+        lines = []
+        count, offset = read_varint(data, 1)
+        for index in range(count):
+            if offset >= len(data) or data[offset] >= len(ITEM_VERBS):
+                raise FrameError('Bad item in binary message')
+            status = data[offset]
+            amount, offset = read_varint(data, offset + 1)
+            item, offset = read_name(data, offset, names)
+            lines.append('{} {}'.format(describe_items(amount, item), ITEM_VERBS[status]))
+        return '\n'.join(lines)
+    if opcode == REPLY_EXIT:
+        if len(data) < 2 or data[1] >= len(DIRECTIONS):
+            raise FrameError('Bad direction in binary message')
+        port, offset = read_varint(data, 2)
+        hostname, offset = read_text(data, offset)
+        reply = '{} {} {}'.format(DIRECTIONS[data[1]], hostname, port)
+        if offset < len(data):
+            reply += ' ' + bytes(data[offset:]).decode(errors='replace')
+        return reply
+    raise FrameError('Unknown binary reply {}'.format(opcode))
+
+
+# Decode a binary event into the text the room would have sent.
+
+def decode_event(data, names):
+    if not data:
+        raise FrameError('Empty binary message')
+    opcode = data[0]
+    if opcode == EVENT_TEXT:
+        return bytes(data[1:]).decode(errors='replace')
+    if opcode not in (EVENT_ENTERED, EVENT_LEFT, EVENT_SAID):
+        raise FrameError('Unknown binary event {}'.format(opcode))
+    player, offset = read_name(data, 1, names)
+    if opcode == EVENT_ENTERED:
+        return 'User {} entered the room.'.format(player)
+    if opcode == EVENT_SAID:
+        return '{} said "{}"'.format(player, bytes(data[offset:]).decode(errors='replace'))
+    if offset >= len(data):
+        raise FrameError('Bad direction in binary message')
+    if data[offset] == LEFT_SERVER:
+        return 'User {} has left the server'.format(player)
+    if data[offset] >= len(DIRECTIONS):
+        raise FrameError('Bad direction in binary message')
+    return 'User {} left going {}.'.format(player, DIRECTIONS[data[offset]])
@@ -0,0 +1,128 @@
+# Commands are parsed once into a Command, looked up by name in a table of handlers and
+# answered with a list of responses.  Handlers decide what happens; the room turns the
+# responses into text or binary frames for whoever they're for.  New commands register
+# themselves with @register and cost no more to dispatch than the built in ones.
+
+
+# A command as a player sent it: the command word, the words after it, and everything
+# after the command word as it was typed, for commands that take free text.
+
+class Command:
+    __slots__ = ('name', 'args', 'text')
+
+    def __init__(self, name, args, text):
+        self.name = name
+        self.args = args
+        self.text = text
+
+
+def parse_command(message):
+    words = message.split()
+    if not words:
+        return Command('', [], '')
+    return Command(words[0], words[1:], message.lstrip()[len(words[0]) + 1:])
+
+
+# Handlers by command word: (function, whether the player has to be in a room first,
+# whether the command does nothing but talk to the room).  A handler is called with the
+# player's session and the Command, and returns a list of responses.  Commands that only
+# talk to the room are the first to be turned away when the room is busy.
+
+handlers = {}
+
+
+def register(*names, needs_room=True, chatter=False):
+    def decorator(function):
+        for name in names:
+            handlers[name] = (function, needs_room, chatter)
+        return function
+    return decorator
+
+
+# Responses.
+
+# A reply of plain text.
+
+class Reply:
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+
+# A reply with a room's summary.
+
+class Summary:
+    __slots__ = ('room',)
+
+    def __init__(self, room):
+        self.room = room
+
+
+# A reply with the summary of the player's room and who else is in it.
+
+class Look:
+    __slots__ = ()
+
+
+# A reply to taking or dropping items: (what happened, count, item) for each.
+
+class Items:
+    __slots__ = ('results',)
+
+    def __init__(self, results):
+        self.results = results
+
+
+# A reply saying an exit leads to a room on another server.
+
+class ExitReply:
+    __slots__ = ('direction', 'destination')
+
+    def __init__(self, direction, destination):
+        self.direction = direction
+        self.destination = destination
+
+
+# An event for everyone in a room but the player, optionally with its binary form as
+# (opcode, player, detail).
+
+class Event:
+    __slots__ = ('room', 'text', 'binary')
+
+    def __init__(self, room, text, binary=None):
+        self.room = room
+        self.text = text
+        self.binary = binary
+
+
+# An event for one other player.
+
+class Tell:
+    __slots__ = ('session', 'text')
+
+    def __init__(self, session, text):
+        self.session = session
+        self.text = text
+
+
+# An event for the players in a room listening to a channel, but not the player.
+
+class ChannelEvent:
+    __slots__ = ('room', 'channel', 'text')
+
+    def __init__(self, room, channel, text):
+        self.room = room
+        self.channel = channel
+        self.text = text
+
+
+# A shout or channel message passed on to a room in another process, as a (hostname,
+# port, room name) tuple.
+
+class Relay:
+    __slots__ = ('destination', 'message')
+
+    def __init__(self, destination, message):
+        self.destination = destination
+        self.message = message
@@ -0,0 +1,56 @@
+import array
+import socket
+
+# Passing open file descriptors between processes over a Unix socket (SCM_RIGHTS), so a
+# player's connection can move to another process without them reconnecting.
+
+
+# Send a message along with some file descriptors.
+
+def send_fds(sock, message, fds):
+    return sock.sendmsg([message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+
+# Receive a message and any file descriptors that came with it.  Returns (message, fds).
+
+def recv_fds(sock, bufsize, maxfds):
+    fds = array.array('i')
+    message, ancdata, flags, address = sock.recvmsg(bufsize, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    return message, list(fds)
+
+
+# Bundles: any number of file descriptors and a message of any size, sent over a
+# SOCK_SEQPACKET socket as a run of packets.  Descriptors go first, a batch at a time
+# tagged F, then the message in pieces tagged M, then an E to say that's everything.
+
+# Most descriptors sent in one packet (Linux takes at most 253), and largest piece of the message.
+
+MAX_FDS = 250
+PIECE = 32 * 1024
+
+
+def send_bundle(sock, message, fds):
+    for start in range(0, len(fds), MAX_FDS):
+        send_fds(sock, b'F', fds[start:start + MAX_FDS])
+    for start in range(0, len(message), PIECE):
+        sock.send(b'M' + message[start:start + PIECE])
+    sock.send(b'E')
+
+
+# Receive a bundle.  Returns (message, fds), with the descriptors in the order they were sent.
+
+def recv_bundle(sock):
+    pieces = []
+    fds = []
+    while True:
+        packet, received = recv_fds(sock, PIECE + 1, MAX_FDS)
+        fds.extend(received)
+        if packet == b'E':
+            return b''.join(pieces), fds
+        elif packet[:1] == b'M':
+            pieces.append(packet[1:])
+        elif packet != b'F':
+            raise OSError('Bundle ended before it was complete')
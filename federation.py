@@ -0,0 +1,157 @@
+import itertools
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from protocol import frame_message, FrameError, MAX_FRAME, KIND_LINK, KIND_LINK_HELLO
+
+# Federation.  Each room process keeps a persistent link, a TCP connection carrying
+# messages for all its rooms, to every other process its exits lead to.  Shouts and
+# channel messages are relayed over the links, so they spread across the whole world
+# rather than stopping at the edge of one process.
+#
+# A message is a list [id, hops, channel, sender, origin, text, room]: an id unique to
+# the message, how many more exits it may pass through, the channel it was sent on (None
+# for a shout), who sent it and from which room, what they said, and the room it's
+# arriving in on the far side of the link (None for whichever room the process starts
+# players in).  Each process remembers which rooms every recent message has reached,
+# so a message coming back round a loop, or arriving by two routes, is only shown once.
+# Messages queued for a link during a tick go out together in one frame.
+#
+# A link starts with a hello giving the port the process opening it serves players on.
+# The other end only takes batches from a process one of its own exits leads to (or one
+# it was told to with --link-from), and only so many messages a second from each.
+
+# How long a message is remembered, in seconds, and the most messages remembered at once.
+
+SEEN_LIFETIME = 60.0
+SEEN_CAPACITY = 10000
+
+# Most messages held for a link while it connects.  Older ones are dropped first.
+
+LINK_BACKLOG = 1000
+
+# Seconds to wait before trying a link again after it failed.
+
+LINK_RETRY = 5.0
+
+# Messages a second a link may bring in, after a burst of as many.  Batches beyond that
+# are dropped whole.
+
+LINK_RATE = 2000.0
+
+# Ids are this process's prefix and a count, so they're unique without any coordination.
+
+ID_PREFIX = os.urandom(6).hex()
+id_counter = itertools.count()
+
+
+def new_message_id():
+    return '{}.{}'.format(ID_PREFIX, next(id_counter))
+
+
+# The rooms each recent message has reached in this process, forgetting messages once
+# they're older than lifetime seconds or there are more than capacity of them.
+
+class SeenMessages:
+    __slots__ = ('capacity', 'lifetime', 'entries')
+
+    def __init__(self, capacity=SEEN_CAPACITY, lifetime=SEEN_LIFETIME):
+        self.capacity = capacity
+        self.lifetime = lifetime
+        # Message id -> (when it's forgotten, set of rooms reached), oldest first.
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # The set of rooms a message has reached, empty the first time it's seen.  Rooms are
+    # names here, or (hostname, port, room name) tuples for rooms it was sent on to.
+
+    def reached(self, message_id):
+        now = time.monotonic()
+        entries = self.entries
+        while entries:
+            oldest = next(iter(entries.values()))
+            if oldest[0] > now:
+                break
+            entries.popitem(last=False)
+        found = entries.get(message_id)
+        if found is None:
+            found = entries[message_id] = (now + self.lifetime, set())
+            if len(entries) > self.capacity:
+                entries.popitem(last=False)
+        return found[1]
+
+
+# One end of a link we opened to another room process.  The session is None until
+# the connection is made, and again once it fails.
+
+class Link:
+    __slots__ = ('address', 'session', 'connecting', 'outbox', 'retry_at')
+
+    def __init__(self, address):
+        self.address = address
+        self.session = None
+        self.connecting = False
+        # Encoded messages waiting for the end of the tick, or for the link to connect.
+        self.outbox = deque(maxlen=LINK_BACKLOG)
+        self.retry_at = 0.0
+
+
+# The hello that starts a link, from a process serving players on port.
+
+def hello_frame(port):
+    return frame_message(str(port), KIND_LINK_HELLO)
+
+
+# The port in a link hello, raising FrameError if it isn't one.
+
+def decode_hello(payload):
+    if not payload.isdigit() or not 0 < int(payload) < 65536:
+        raise FrameError('Malformed link hello')
+    return int(payload)
+
+
+# Encode a message for a link, or return None if it's too big to fit in a frame.
+
+def encode_message(message):
+    encoded = json.dumps(message, separators=(',', ':')).encode()
+    if len(encoded) + 2 > MAX_FRAME:
+        return None
+    return encoded
+
+
+# Pack encoded messages into as few link frames as will hold them.
+
+def batch_frames(encoded):
+    frames = []
+    batch = []
+    size = 2
+    for message in encoded:
+        if batch and size + len(message) + 1 > MAX_FRAME:
+            frames.append(frame_message(b'[' + b','.join(batch) + b']', KIND_LINK))
+            batch = []
+            size = 2
+        batch.append(message)
+        size += len(message) + 1
+    if batch:
+        frames.append(frame_message(b'[' + b','.join(batch) + b']', KIND_LINK))
+    return frames
+
+
+# Unpack the messages in a link frame, raising FrameError if it isn't one.
+
+def decode_batch(payload):
+    try:
+        messages = json.loads(payload)
+    except ValueError:
+        raise FrameError('Link frame is not JSON')
+    if not isinstance(messages, list):
+        raise FrameError('Link frame is not a list of messages')
+    for message in messages:
+        if (not isinstance(message, list) or len(message) != 7 or not isinstance(message[0], str)
+                or not isinstance(message[1], int) or not all(isinstance(field, str) for field in message[3:6])
+                or not isinstance(message[2], (str, type(None))) or not isinstance(message[6], (str, type(None)))):
+            raise FrameError('Malformed link message')
+    return messages
@@ -0,0 +1,108 @@
+import re
+from collections import Counter
+
+# Items are kept as counts rather than lists, for rooms and players alike, so a room
+# holding a thousand torches costs one entry rather than a thousand.
+
+# Pattern of one line of a take, drop or give reply, such as "torch taken", "3 x torch dropped"
+# or "rope given to alice".
+
+ITEM_REPLY = re.compile(r'^(?:(\d+) x )?(\S+) (taken|dropped|given to \S+)$')
+
+# Pattern of the event a player gets when someone gives them something.  Gifts start
+# with GIFT_MARK, which no player's name may, so nothing another player says or emotes
+# can pass for one.
+
+GIFT_MARK = '*'
+ITEM_GIFT = re.compile(r'^\* \S+ gave you (?:(\d+) x )?(\S+)\.$')
+
+
+# Make a counted item store out of a list of item names.
+
+def make_store(items=()):
+    return Counter(items)
+
+
+# Parse the items named in a take or drop command.  Each item may be preceded by how many
+# of it, or by "all".  Returns a list of (count, item), where a count of None means all of
+# that item, or None if the list doesn't make sense.
+
+def parse_item_counts(words):
+    counts = []
+    count = 1
+    pending = False
+    for word in words:
+        if word == 'all':
+            count = None
+            pending = True
+        elif word.isdigit():
+            count = int(word)
+            pending = True
+            if count == 0:
+                return None
+        else:
+            counts.append((count, word))
+            count = 1
+            pending = False
+    if pending or not counts:
+        return None
+    return counts
+
+
+# Describe some number of an item, as in "torch" or "12 x torch".
+
+def describe_items(count, item):
+    if count == 1:
+        return item
+    return '{} x {}'.format(count, item)
+
+
+# Take some of an item out of a store, if there are enough.  Returns True if they were taken.
+
+def remove_items(store, item, count):
+    available = store.get(item, 0)
+    if count > available or available == 0:
+        return False
+    if count == available:
+        del store[item]
+    else:
+        store[item] = available - count
+    return True
+
+
+# Put some of an item in a store.
+
+def add_items(store, item, count):
+    store[item] = store.get(item, 0) + count
+
+
+# Turn a store into the words of a command naming everything in it, as in "3 torch sword".
+
+def command_words(store):
+    words = []
+    for item, count in store.items():
+        if count != 1:
+            words.append(str(count))
+        words.append(item)
+    return words
+
+
+# Read one line of a take, drop or give reply.  Returns (count, item, verb) or None if the line
+# says something else, such as that the item couldn't be taken.
+
+def parse_item_reply(line):
+    match = ITEM_REPLY.match(line)
+    if match is None:
+        return None
+    count, item, verb = match.groups()
+    return (int(count) if count else 1, item, verb)
+
+
+# Read an event saying someone gave the player something.  Returns (count, item) or None.
+
+def parse_gift(line):
+    match = ITEM_GIFT.match(line)
+    if match is None:
+        return None
+    count, item = match.groups()
+    return (int(count) if count else 1, item)
@@ -0,0 +1,255 @@
+import json
+import os
+import queue
+import threading
+import time
+
+# Durable room state.  Every change to what a room holds or what a player is carrying is
+# appended to a journal as one short JSON line, and every so often the whole state is
+# written out as a snapshot and the journal started afresh.  Restarting means reading the
+# snapshot and replaying the few records after it.  Writing and syncing happen on a
+# background thread, so the event loop only ever hands over bytes and never waits on disk.
+#
+# Snapshots and journals are numbered by generation.  A snapshot of generation G holds
+# everything journaled before it, and the journal started after it begins with a
+# ["s", G] record, so a journal left behind by a crash between writing a snapshot and
+# starting the journal afresh is recognised as older and isn't replayed twice.  Journals
+# and snapshots from before generations were kept count as generation 0.
+#
+# Records are lists whose first element says what happened:
+#   ["r", room, {item: count}]         a room was loaded from the world file holding these
+#   ["t", room, item, count, player]   player took items from a room
+#   ["d", room, item, count, player]   player dropped items in a room
+#   ["j", player, room]                player joined or walked into a room
+#   ["g", giver, receiver, item, count] player handed items to another player
+#   ["n", old name, new name]          player changed their name
+#   ["x", player]                      player left the game, taking what they held with them
+
+JOURNAL_FILE = 'journal.log'
+SNAPSHOT_FILE = 'snapshot.json'
+
+
+# State as kept on disk: items in each room, items each player holds, and the room each
+# player was last in, all as plain dictionaries.
+
+def empty_state():
+    return {'rooms': {}, 'holdings': {}, 'places': {}}
+
+
+# The generation of a journal file, from the record it starts with, or None if it's empty.
+
+def journal_generation(path):
+    try:
+        with open(path, 'rb') as journal_file:
+            first = journal_file.readline()
+    except FileNotFoundError:
+        return None
+    if not first:
+        return None
+    try:
+        record = json.loads(first)
+    except ValueError:
+        return 0
+    return record[1] if record[0] == 's' else 0
+
+
+# Add to or take away from a count of items, forgetting items that run out.
+
+def change_count(counts, item, change):
+    count = counts.get(item, 0) + change
+    if count > 0:
+        counts[item] = count
+    else:
+        counts.pop(item, None)
+
+
+# Apply one journal record to a state.
+
+def apply_record(state, record):
+    kind = record[0]
+    if kind == 'r':
+        state['rooms'][record[1]] = dict(record[2])
+    elif kind == 't' or kind == 'd':
+        room, item, count, player = record[1:]
+        if kind == 'd':
+            count = -count
+        change_count(state['rooms'].setdefault(room, {}), item, -count)
+        holdings = state['holdings'].setdefault(player, {})
+        change_count(holdings, item, count)
+        if not holdings:
+            del state['holdings'][player]
+    elif kind == 'g':
+        giver, receiver, item, count = record[1:]
+        held = state['holdings'].get(giver, {})
+        change_count(held, item, -count)
+        if not held:
+            state['holdings'].pop(giver, None)
+        change_count(state['holdings'].setdefault(receiver, {}), item, count)
+    elif kind == 'j':
+        state['places'][record[1]] = record[2]
+    elif kind == 'n':
+        old_name, new_name = record[1:]
+        if old_name in state['holdings']:
+            state['holdings'][new_name] = state['holdings'].pop(old_name)
+        if old_name in state['places']:
+            state['places'][new_name] = state['places'].pop(old_name)
+    elif kind == 'x':
+        state['holdings'].pop(record[1], None)
+        state['places'].pop(record[1], None)
+
+
+# Read the state saved in a directory: the last snapshot, with the journal replayed on top
+# if it was started after that snapshot.  A record cut short by a crash can only be the
+# last one, and is ignored.
+
+def load_state(directory):
+    state = empty_state()
+    try:
+        with open(os.path.join(directory, SNAPSHOT_FILE)) as snapshot_file:
+            state.update(json.load(snapshot_file))
+    except FileNotFoundError:
+        pass
+    generation = state.pop('generation', 0)
+    replayed = 0
+    try:
+        with open(os.path.join(directory, JOURNAL_FILE), 'rb') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if record[0] == 's':
+                    if record[1] < generation:
+                        break
+                    continue
+                apply_record(state, record)
+                replayed += 1
+    except FileNotFoundError:
+        pass
+    return state, replayed
+
+
+# The generation of the snapshot in a directory, 0 if there's none.
+
+def snapshot_generation(directory):
+    try:
+        with open(os.path.join(directory, SNAPSHOT_FILE)) as snapshot_file:
+            return json.load(snapshot_file).get('generation', 0)
+    except FileNotFoundError:
+        return 0
+
+
+# The record a journal of a generation starts with.
+
+def generation_record(generation):
+    return json.dumps(['s', generation], separators=(',', ':')).encode() + b'\n'
+
+
+# Appends records to the journal of a directory and writes snapshots, on a thread of its own.
+
+class Journal:
+
+    def __init__(self, directory, sync_interval):
+        self.directory = directory
+        self.sync_interval = sync_interval
+        # Encoded records waiting to be handed to the writer at the end of the loop pass.
+        self.pending = []
+        # Records written since the last snapshot.
+        self.records = 0
+        self.queue = queue.SimpleQueue()
+        os.makedirs(directory, exist_ok=True)
+        # Carry on with the journal there is, unless the snapshot has overtaken it, in
+        # which case everything in it is in the snapshot already.
+        path = os.path.join(directory, JOURNAL_FILE)
+        self.generation = snapshot_generation(directory)
+        current = journal_generation(path)
+        if current is not None and current >= self.generation:
+            self.generation = current
+            self.file = open(path, 'ab')
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(generation_record(self.generation))
+        self.thread = threading.Thread(target=self.write_loop, name='journal', daemon=True)
+        self.thread.start()
+
+    # Note a change.  Nothing is written until the next flush.
+
+    def record(self, *fields):
+        self.pending.append(json.dumps(fields, separators=(',', ':')).encode() + b'\n')
+
+    # Hand everything recorded since the last flush to the writer as one batch.
+
+    def flush(self):
+        if self.pending:
+            self.records += len(self.pending)
+            self.queue.put(b''.join(self.pending))
+            self.pending.clear()
+
+    # Hand the writer a copy of the whole state to save as a snapshot.  Everything
+    # recorded before it is already in the state, so the journal can start again after it.
+
+    def snapshot(self, state):
+        self.flush()
+        self.records = 0
+        self.queue.put(state)
+
+    # Write out everything outstanding and stop the writer.
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    # The writer thread.  Batches are written as they come and synced at most once per
+    # sync interval, or as soon as the writer goes idle.
+
+    def write_loop(self):
+        last_sync = time.monotonic()
+        unsynced = False
+        while True:
+            try:
+                item = self.queue.get(timeout=self.sync_interval if unsynced else None)
+            except queue.Empty:
+                item = b''
+            if item is None:
+                self.sync()
+                self.file.close()
+                return
+            if isinstance(item, dict):
+                self.write_snapshot(item)
+                unsynced = False
+                last_sync = time.monotonic()
+                continue
+            if item:
+                self.file.write(item)
+                unsynced = True
+            now = time.monotonic()
+            if unsynced and (not item or now - last_sync >= self.sync_interval):
+                self.sync()
+                unsynced = False
+                last_sync = now
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # Save a snapshot of the next generation next to the journal, replacing the old one in
+    # one step, then start a journal of that generation.
+
+    def write_snapshot(self, state):
+        self.generation += 1
+        state = dict(state, generation=self.generation)
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        with open(path + '.tmp', 'w') as snapshot_file:
+            json.dump(state, snapshot_file, separators=(',', ':'))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(path + '.tmp', path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.file.close()
+        self.file = open(os.path.join(self.directory, JOURNAL_FILE), 'wb')
+        self.file.write(generation_record(self.generation))
@@ -0,0 +1,136 @@
+import bisect
+
+# Lightweight instrumentation for the room server.  Counters are plain integers in a
+# dictionary and histograms have fixed buckets, so recording something costs a couple
+# of dictionary lookups and leaves the collection cheap enough to keep on all the time.
+# Everything can be rendered in the Prometheus text exposition format.
+
+# Upper bounds, in seconds, of the buckets used for timing histograms.
+
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# A histogram with fixed buckets.  counts has one more entry than bounds, for values
+# above the last bound.
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    # Estimate a percentile as the upper bound of the bucket it falls in.
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return self.bounds[index] if index < len(self.bounds) else float('inf')
+        return float('inf')
+
+
+# Counters, keyed by (name, label value), with a label value of None for unlabelled ones.
+
+counters = {}
+
+# Histograms, keyed the same way.
+
+histograms = {}
+
+# Gauges, read when the metrics are rendered: name -> function returning the value.
+
+gauges = {}
+
+# Help text and the label name (if any) of every metric, by name.
+
+descriptions = {}
+
+
+# Describe a metric so it can be rendered with help text and the right label.
+
+def describe(name, text, label=None):
+    descriptions[name] = (text, label)
+
+
+# Add to a counter.
+
+def increment(name, amount=1, label=None):
+    key = (name, label)
+    counters[key] = counters.get(key, 0) + amount
+
+
+# Find a histogram, creating it the first time it's needed.
+
+def histogram(name, label=None):
+    key = (name, label)
+    found = histograms.get(key)
+    if found is None:
+        found = histograms[key] = Histogram()
+    return found
+
+
+# Register a function that reports the current value of a gauge.
+
+def register_gauge(name, text, function):
+    describe(name, text)
+    gauges[name] = function
+
+
+# Render the labels part of a metric line.
+
+def format_labels(name, label, extra=''):
+    parts = []
+    label_name = descriptions.get(name, ('', None))[1]
+    if label is not None and label_name is not None:
+        parts.append('{}="{}"'.format(label_name, label))
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+# Render a header for a metric once.
+
+def header(lines, done, name, kind):
+    if name in done:
+        return
+    done.add(name)
+    text = descriptions.get(name, (name, None))[0]
+    lines.append('# HELP {} {}'.format(name, text))
+    lines.append('# TYPE {} {}'.format(name, kind))
+
+
+# Render everything in the Prometheus text exposition format.
+
+def render_prometheus():
+    lines = []
+    done = set()
+    for (name, label), value in sorted(counters.items(), key=lambda entry: (entry[0][0], str(entry[0][1]))):
+        header(lines, done, name, 'counter')
+        lines.append('{}{} {}'.format(name, format_labels(name, label), value))
+    for name, function in sorted(gauges.items()):
+        header(lines, done, name, 'gauge')
+        lines.append('{} {}'.format(name, function()))
+    for (name, label), found in sorted(histograms.items(), key=lambda entry: (entry[0][0], str(entry[0][1]))):
+        header(lines, done, name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(found.bounds, found.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(name, format_labels(name, label, 'le="{}"'.format(bound)),
+                                                 cumulative))
+        lines.append('{}_bucket{} {}'.format(name, format_labels(name, label, 'le="+Inf"'), found.count))
+        lines.append('{}_sum{} {}'.format(name, format_labels(name, label), found.total))
+        lines.append('{}_count{} {}'.format(name, format_labels(name, label), found.count))
+    return '\n'.join(lines) + '\n'
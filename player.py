@@ -1,9 +1,18 @@
+import os
 import socket
 import selectors
 import signal
+import stat
 import sys
+import time
 import argparse
+from collections import deque
 from urllib.parse import urlparse
+from protocol import frame_message, unframe_messages, FrameError, KIND_REPLY, KIND_EVENT, KIND_BINARY_COMMAND, \
+    KIND_BINARY_REPLY, KIND_BINARY_EVENT, KIND_HEARTBEAT, SERVER_BUSY
+from binary import NameTable, encode_command, decode_reply, decode_event
+from itemstore import make_store, parse_item_counts, describe_items, remove_items, add_items, \
+    command_words, parse_item_reply, parse_gift
 
 # Constant list used for checking if a movement command was called
 DIRECTIONS = ['NORTH', 'SOUTH', 'EAST', 'WEST', 'UP', 'DOWN']
@@ -15,13 +24,17 @@ client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
 server = ('', '')
 
+# Room to ask for when the server hosts a whole world of rooms, if any.
+
+room_name = None
+
 # User name for player.
 
 name = ''
 
-# Inventory of items.
+# Inventory of items, with how many of each we hold.
 
-inventory = []
+inventory = make_store()
 
 # Selector setup
 client_selector = selectors.DefaultSelector()
@@ -29,26 +42,209 @@ client_selector = selectors.DefaultSelector()
 # Command word for use in processing server messages
 in_command = ""
 
+# Bytes received from the server that haven't made up a complete message yet.
+receive_buffer = bytearray()
+
+# Bytes waiting for the server to take them.
+send_buffer = bytearray()
+
+# Commands sent that haven't been answered yet, oldest first, with when each was sent and
+# what to do with the reply if it isn't just to be shown.  The room answers every command
+# with exactly one reply, in order.
+in_flight = deque()
+
+# Warm connections to rooms next door that are served elsewhere, keyed by (host, port, room),
+# so walking through an exit only means switching sockets.  Each one peeks at its room, so
+# the room can be shown the moment we walk in.
+
+class Neighbour:
+    __slots__ = ('destination', 'sock', 'buffer', 'connected', 'peeks', 'summary', 'last_used')
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.buffer = bytearray()
+        self.connected = False
+        # Peeks sent that haven't been answered yet, and what the last answer said.
+        self.peeks = 0
+        self.summary = None
+        self.last_used = time.monotonic()
+
+
+neighbours = {}
+
+# Exits out of the room we're in that lead to other servers, by direction.
+remote_exits = {}
+
+# What was shown on walking into a room before the room itself answered.
+shown_summary = None
+
+# Most warm connections kept, and how long, in seconds, one that no longer leads anywhere
+# from where we are is kept around in case we head back that way.
+POOL_SIZE = 8
+IDLE_TIMEOUT = 30.0
+
+# Talking to the room in binary rather than text, and the names each side has sent so far
+# in this session.
+binary = False
+sent_names = NameTable()
+received_names = []
+
+# Where commands are read from, typed or from a script, and what has been read of it
+# that isn't a complete line yet.  Lines read but not acted on yet wait in input_lines.
+input_file = sys.stdin
+input_buffer = bytearray()
+input_lines = deque()
+input_done = False
+
+# Batch mode: commands come from a script rather than a person, several are kept in
+# flight at once, and round trip times are reported at the end.
+batch = False
+window = 32
+quiet = False
+leaving = False
+started = 0.0
+round_trips = {}
+
+# Commands that depend on what we hold, so in batch mode they wait for every earlier
+# reply (which may have changed our inventory) before they're looked at.
+INVENTORY_COMMANDS = ('drop', 'give', 'inventory')
+
+# What we answer the room's heartbeats with, on every connection, warm ones included, so
+# a room that drops idle players knows we're still here.
+HEARTBEAT_FRAME = frame_message(b'', KIND_HEARTBEAT)
+
 # Signal handler for graceful exiting.  Let the server know when we're gone.
 
 def signal_handler(sig, frame):
     print('Interrupt received, shutting down ...')
-    message = 'exit'
-    client_socket.sendto(message.encode(), server)
-    for item in inventory:
-        message = f'drop {item}'
-        client_socket.sendto(message.encode(), server)
+    try:
+        client_socket.setblocking(True)
+        client_socket.sendall(bytes(send_buffer) + b''.join(frame_message(command)
+                                                            for command in leaving_commands()))
+    except OSError:
+        pass
     sys.exit(0)
 
 
+# The commands to send when leaving: drop everything we're holding in one go, then exit.
+# The room handles commands in order, so the drop arrives ahead of the exit.
+
+def leaving_commands():
+    commands = []
+    if inventory:
+        commands.append(' '.join(['drop'] + command_words(inventory)))
+    return commands + ['exit']
+
+
+# Send a command to the server, noting when it went so its reply can be timed.
+
+def send_command(command, handler=None):
+    in_flight.append((command, time.perf_counter(), handler))
+    if binary:
+        send_data(frame_message(encode_command(sent_names, command), KIND_BINARY_COMMAND))
+    else:
+        send_data(frame_message(command))
+
+
+# The command to join the room we're connecting to.
+
+def join_message():
+    message = f'join {name}'
+    if room_name is not None:
+        message += f' {room_name}'
+    if binary:
+        message += ' +binary'
+    return message
+
+
+# Send as much as the server will take without waiting, keeping the rest until it can take more.
+
+def send_data(data):
+    send_buffer.extend(data)
+    try:
+        sent = client_socket.send(send_buffer)
+    except BlockingIOError:
+        sent = 0
+    del send_buffer[:sent]
+    update_interest()
+
+
+# Only ask the selector about writes while there's something waiting to be sent.
+
+def update_interest():
+    events = selectors.EVENT_READ
+    if send_buffer:
+        events |= selectors.EVENT_WRITE
+    if client_socket in client_selector.get_map():
+        client_selector.modify(client_socket, events, handle_data_from_server)
+
+
 # Simple function for setting up a prompt for the user.
 
 def do_prompt(skip_line=False):
     if skip_line:
         print("")
     print("> ", end='', flush=True)
-    line = sys.stdin.readline()
-    process_command(line)
+
+
+# Read whatever has been typed or piped in, without waiting for more, and act on every
+# complete line of it.
+
+def handle_keyboard_input(file, mask):
+    read_input()
+    if batch:
+        run_script()
+        return
+    while input_lines:
+        process_command(input_lines.popleft())
+        do_prompt()
+    if input_done:
+        process_command('exit')
+
+
+# Read once from where commands come from, splitting what arrives into lines.  The
+# selector only calls on us when there's something to read, so this never waits.
+
+def read_input():
+    global input_done
+    data = os.read(input_file.fileno(), 65536)
+    if not data:
+        input_done = True
+        if input_file in client_selector.get_map():
+            client_selector.unregister(input_file)
+    input_buffer.extend(data)
+    lines = input_buffer.split(b'\n')
+    input_buffer[:] = lines.pop()
+    if input_done and input_buffer:
+        lines.append(bytes(input_buffer))
+        input_buffer.clear()
+    input_lines.extend(line.decode(errors='replace') for line in lines)
+
+
+# Work through a script, keeping up to a window of commands in flight.  Once the script
+# runs out we leave the room as a player would.
+
+def run_script():
+    while not leaving and len(in_flight) < window:
+        if not input_lines:
+            # A script in a regular file is read as it's needed, as it can't be waited on.
+            if input_done or input_file in client_selector.get_map():
+                break
+            read_input()
+            continue
+        line = input_lines[0].strip()
+        word = line.split(' ', 1)[0]
+        # A move may take us to another server, so everything before it has to be answered first.
+        if (word in INVENTORY_COMMANDS or word.upper() in DIRECTIONS) and in_flight:
+            break
+        input_lines.popleft()
+        if line and not line.startswith('#'):
+            process_command(line)
+    # Leaving drops what we hold, so wait until we know what that is.
+    if input_done and not input_lines and not leaving and not in_flight:
+        process_command('exit')
 
 
 # Function to join a room.
@@ -58,32 +254,354 @@ def join_room():
     global server
     try:
         client_socket.connect(server)
-        message = f'join {name}'
-        client_socket.send(message.encode())
-        response, addr = client_socket.recvfrom(1024)
-        response = response.decode()
-        print(response)
+        client_socket.sendall(frame_message(join_message()))
+        frames = []
+        while not frames:
+            data = client_socket.recv(4096)
+            if not data:
+                print('Error: Room closed the connection.')
+                sys.exit(1)
+            receive_buffer.extend(data)
+            frames = unframe_messages(receive_buffer)
+        if frames[0] == (KIND_REPLY, SERVER_BUSY.encode()):
+            print('Error: Room is too busy to take another player, try again later.')
+            sys.exit(1)
+        # Rejoining a room that kept what we were carrying hands it back to us.  Anything
+        # that came in behind the reply, binary events included, is handled as usual.
+        handle_frames(frames, timed=False)
+    except FrameError:
+        print('Error: Room sent a malformed message.')
+        sys.exit(1)
     except ConnectionRefusedError:
         print('Error: Host or port is not accepting connections.')
         sys.exit(1)
 
 
-# Function for receiving data from client socket
+# Function for receiving data from client socket, and sending anything the socket wasn't
+# ready for earlier.
 def handle_data_from_server(sock, mask):
-    message = sock.recv(1024)
-    message = message.decode()
-    words = str(message.split())
+    # We may have walked out of the room since the selector reported this socket.
+    if sock is not client_socket:
+        return
+    if mask & selectors.EVENT_WRITE:
+        send_data(b'')
+    if not mask & selectors.EVENT_READ:
+        return
+    try:
+        data = sock.recv(4096)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        data = b''
+    if not data:
+        if batch:
+            report_round_trips()
+            sys.exit(0 if leaving and not in_flight else 1)
+        print('Disconnected from room.')
+        sys.exit(0)
+    receive_buffer.extend(data)
+    try:
+        handle_frames(unframe_messages(receive_buffer))
+    except FrameError:
+        print('Error: Room sent a malformed message.')
+        sys.exit(1)
+    if batch:
+        run_script()
+
+
+# Deal with frames from the server, decoding binary ones and answering heartbeats.
+
+def handle_frames(frames, timed=True):
+    for kind, payload in frames:
+        if kind == KIND_HEARTBEAT:
+            send_data(HEARTBEAT_FRAME)
+        elif kind == KIND_BINARY_REPLY:
+            handle_message(KIND_REPLY, decode_reply(payload, received_names), timed)
+        elif kind == KIND_BINARY_EVENT:
+            handle_message(KIND_EVENT, decode_event(payload, received_names), timed)
+        else:
+            handle_message(kind, payload.decode(), timed)
 
-    # For 'take' command response
-    if (len(words) == 2) and (words[1] == 'taken'):
-        inventory.append(words[0])
-    # For 'drop' command response
-    if len(words) == 2 and words[1] == 'dropped':
-        inventory.remove(words[1])
 
-    print(message)
+# Function for dealing with a single message from the server
+def handle_message(kind, message, timed=True):
+    if kind == KIND_HEARTBEAT:
+        return
+    # Each reply answers the oldest command still in flight.  A move the room says leads
+    # to another server takes us there.
+    handler = None
+    if kind == KIND_REPLY and timed and in_flight:
+        command, sent, handler = in_flight.popleft()
+        words = command.split()
+        word = 'move' if words[0].upper() in DIRECTIONS else words[0]
+        destination = parse_remote_exit(message)
+        if word == 'move' and handler is None and destination is not None and not in_flight:
+            walk_to(command, destination, sent)
+            return
+        round_trips.setdefault(word, []).append(time.perf_counter() - sent)
+
+    # Someone handing us something tells us so, as in "* alice gave you 2 x rope."
+    if kind == KIND_EVENT:
+        gift = parse_gift(message)
+        if gift is not None:
+            add_items(inventory, gift[1], gift[0])
+
+    # Replies to take, drop and give have a line for each item, as in "3 x torch taken".
+    if kind == KIND_REPLY:
+        for line in message.split('\n'):
+            result = parse_item_reply(line)
+            if result is None:
+                continue
+            count, item, verb = result
+            if verb == 'taken':
+                add_items(inventory, item, count)
+            else:
+                remove_items(inventory, item, count)
+
+    if handler is not None:
+        handler(message)
+    elif not quiet:
+        print(message)
+
+
+# Read where an exit to another server leads, from a line such as "north host 9000 Garden".
+# Returns (host, port, room), or None if the line says something else.
+
+def parse_remote_exit(line):
+    words = line.split()
+    if len(words) not in (3, 4) or words[0].upper() not in DIRECTIONS or not words[2].isdigit():
+        return None
+    return (words[1], int(words[2]), words[3] if len(words) == 4 else None)
+
+
+# Ask the room we're in where its exits lead.
+
+def request_exits():
+    send_command('exits', handle_exits)
+
+
+# Note which exits lead to other servers, and warm up connections to the rooms they lead to.
+
+def handle_exits(message):
+    remote_exits.clear()
+    for line in message.split('\n'):
+        destination = parse_remote_exit(line)
+        if destination is not None:
+            remote_exits[line.split()[0].lower()] = destination
+    now = time.monotonic()
+    for destination in remote_exits.values():
+        neighbour = neighbours.get(destination)
+        if neighbour is None:
+            open_neighbour(destination)
+        else:
+            neighbour.last_used = now
+            if neighbour.connected:
+                peek(neighbour)
+    evict_neighbours()
 
 
+# Start connecting to a room next door, without waiting for the connection to be made.
+
+def open_neighbour(destination):
+    neighbour = Neighbour(destination)
+    try:
+        neighbour.sock.connect_ex(destination[:2])
+    except OSError:
+        neighbour.sock.close()
+        return
+    neighbours[destination] = neighbour
+    client_selector.register(neighbour.sock, selectors.EVENT_WRITE, handle_neighbour)
+
+
+# Ask a room next door what it looks like.
+
+def peek(neighbour):
+    command = 'peek' if neighbour.destination[2] is None else f'peek {neighbour.destination[2]}'
+    try:
+        neighbour.sock.send(frame_message(command))
+    except OSError:
+        close_neighbour(neighbour)
+        return
+    neighbour.peeks += 1
+
+
+# Selector callback for a warm connection: finish connecting, then keep what it says about its room.
+
+def handle_neighbour(sock, mask):
+    # We may have walked into its room, or given up on it, since the selector reported it.
+    neighbour = next((found for found in neighbours.values() if found.sock is sock), None)
+    if neighbour is None:
+        return
+    if not neighbour.connected:
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            close_neighbour(neighbour)
+            return
+        neighbour.connected = True
+        client_selector.modify(sock, selectors.EVENT_READ, handle_neighbour)
+        peek(neighbour)
+        return
+    try:
+        data = sock.recv(65536)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        data = b''
+    if not data:
+        close_neighbour(neighbour)
+        return
+    neighbour.buffer.extend(data)
+    try:
+        frames = unframe_messages(neighbour.buffer)
+    except FrameError:
+        close_neighbour(neighbour)
+        return
+    for kind, payload in frames:
+        if kind == KIND_REPLY:
+            neighbour.peeks -= 1
+            neighbour.summary = payload.decode()
+        elif kind == KIND_HEARTBEAT:
+            try:
+                sock.send(HEARTBEAT_FRAME)
+            except OSError:
+                close_neighbour(neighbour)
+                return
+
+
+def close_neighbour(neighbour):
+    del neighbours[neighbour.destination]
+    client_selector.unregister(neighbour.sock)
+    neighbour.sock.close()
+
+
+# Close warm connections we haven't been next to for a while, and the oldest ones past
+# the size of the pool.
+
+def evict_neighbours():
+    now = time.monotonic()
+    nearby = set(remote_exits.values())
+    for neighbour in list(neighbours.values()):
+        if neighbour.destination not in nearby and now - neighbour.last_used > IDLE_TIMEOUT:
+            close_neighbour(neighbour)
+    if len(neighbours) > POOL_SIZE:
+        spare = sorted((neighbour for neighbour in neighbours.values() if neighbour.destination not in nearby),
+                       key=lambda neighbour: neighbour.last_used)
+        for neighbour in spare[:len(neighbours) - POOL_SIZE]:
+            close_neighbour(neighbour)
+
+
+# Walk through an exit into a room on another server.  A warm connection to it becomes the
+# one we play on and we show the room straight away; otherwise we connect now.  Either way
+# we leave the room we were in and join the new one, taking what we hold with us.
+
+def walk_to(command, destination, sent):
+    global client_socket
+    global server
+    global room_name
+    global shown_summary
+    global sent_names
+    neighbour = neighbours.pop(destination, None)
+    if neighbour is not None and neighbour.connected:
+        client_selector.unregister(neighbour.sock)
+        sock = neighbour.sock
+    else:
+        if neighbour is not None:
+            client_selector.unregister(neighbour.sock)
+            neighbour.sock.close()
+            neighbour = None
+        try:
+            sock = socket.create_connection(destination[:2], timeout=5.0)
+        except OSError:
+            print(f'Error: Could not reach the room at {destination[0]} port {destination[1]}.')
+            return
+        sock.setblocking(False)
+
+    depart(client_socket)
+    client_socket = sock
+    server = destination[:2]
+    room_name = destination[2]
+    remote_exits.clear()
+    receive_buffer.clear()
+    # Names are numbered afresh in every session.
+    sent_names = NameTable()
+    received_names.clear()
+    shown_summary = None
+    if neighbour is not None:
+        # Answers to peeks still on their way come first.
+        receive_buffer.extend(neighbour.buffer)
+        for peeked in range(neighbour.peeks):
+            in_flight.append(('peek', time.perf_counter(), ignore_reply))
+        shown_summary = neighbour.summary
+        if shown_summary is not None and not quiet:
+            print(shown_summary)
+    client_selector.register(client_socket, selectors.EVENT_READ, handle_data_from_server)
+    in_flight.append((command, sent, arrived))
+    send_data(frame_message(join_message()))
+
+
+def ignore_reply(message):
+    pass
+
+
+# The room we walked into has answered our join.  Show it, unless it's just what we showed
+# already, and find out where we can go from here.
+
+def arrived(message):
+    if message.startswith('The name '):
+        print(f'Error: {message}')
+        sys.exit(1)
+    if message != shown_summary and not quiet:
+        print(message)
+    if not leaving:
+        request_exits()
+
+
+# Leave the room we're in for one elsewhere.  Whatever was still to be sent goes first,
+# then we read until the room hangs up.
+
+def depart(sock):
+    client_selector.unregister(sock)
+    try:
+        sock.settimeout(1.0)
+        sock.sendall(bytes(send_buffer) + frame_message('exit'))
+        sock.shutdown(socket.SHUT_WR)
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        return
+    finally:
+        send_buffer.clear()
+    client_selector.register(sock, selectors.EVENT_READ, handle_departed)
+
+
+def handle_departed(sock, mask):
+    try:
+        data = sock.recv(65536)
+    except BlockingIOError:
+        return
+    except OSError:
+        data = b''
+    if not data:
+        client_selector.unregister(sock)
+        sock.close()
+
+
+# Report how long the server took to answer each kind of command, for batch runs.
+
+def report_round_trips():
+    elapsed = time.perf_counter() - started
+    total = sum(len(timings) for timings in round_trips.values())
+    print(f'{total} commands answered in {elapsed:.3f} s ({total / elapsed:.1f} commands/s)', file=sys.stderr)
+    if in_flight:
+        print(f'{len(in_flight)} commands were never answered', file=sys.stderr)
+    print('{:<10}{:>8}{:>10}{:>10}{:>10}'.format('command', 'count', 'p50 ms', 'p99 ms', 'max ms'),
+          file=sys.stderr)
+    for word, timings in sorted(round_trips.items()):
+        timings.sort()
+        p50 = timings[int(0.5 * (len(timings) - 1))] * 1000
+        p99 = timings[int(0.99 * (len(timings) - 1))] * 1000
+        print('{:<10}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}'.format(word, len(timings), p50, p99, timings[-1] * 1000),
+              file=sys.stderr)
+
 
 # Function to handle commands from the user, checking them over and sending to the server as needed.
 
@@ -91,56 +609,78 @@ def process_command(command):
     global client_socket
     # Parse command.
 
+    global leaving
+    command = command.strip()
     words = command.split()
+    if not words:
+        return
 
     # Check if we are dropping something.  Only let server know if it is in our inventory.
+    # "drop all" drops everything we hold, and "all" before an item drops all of that item.
 
     if words[0] == 'drop':
-        if len(words) != 2:
+        if words[1:] == ['all']:
+            if not inventory:
+                print('You are not holding anything')
+                return
+            command = ' '.join(['drop'] + command_words(inventory))
+        else:
+            requests = parse_item_counts(words[1:])
+            if requests is None:
+                print("Invalid command")
+                return
+            drops = make_store()
+            for count, item in requests:
+                add_items(drops, item, count if count is not None else inventory.get(item, 1))
+            for item, count in drops.items():
+                if inventory.get(item, 0) < count:
+                    print(f'You are not holding {describe_items(count, item)}')
+                    return
+            command = ' '.join(['drop'] + command_words(drops))
+
+    # Likewise for giving something to another player, as in "give alice 2 rope".
+
+    if words[0] == 'give':
+        requests = parse_item_counts(words[2:])
+        if requests is None or len(requests) != 1:
             print("Invalid command")
             return
-        elif words[1] not in inventory:
-            print(f'You are not holding {words[1]}')
+        count, item = requests[0]
+        if count is None:
+            count = inventory.get(item, 1)
+        if inventory.get(item, 0) < count:
+            print(f'You are not holding {describe_items(count, item)}')
             return
+        command = ' '.join(['give', words[1]] + command_words({item: count}))
 
-    # Send command to server, if it isn't a local only one.
+    # Walking to a room on another server we're already connected to doesn't need to ask
+    # the room we're in first.  Anything else in flight has to be answered before we go.
 
-    if command != 'inventory':
-        message = f'{command}'
-        client_socket.send(message.encode())
+    if len(words) == 1 and words[0].lower() in remote_exits and not in_flight:
+        walk_to(command, remote_exits[words[0].lower()], time.perf_counter())
         return
+
     # Check for particular commands of interest from the user.
 
     if command == 'exit':
-        for item in inventory:
-            message = f'drop {item}'
-            client_socket.send(message.encode())
-
-        sys.exit(0)
-    # elif command == 'look':
-    #     response, addr = client_socket.recvfrom(1024)
-    #     print(response.decode())
+        # Give back everything we are holding before leaving.
+        if not leaving:
+            leaving = True
+            for message in leaving_commands():
+                send_command(message)
+        return
     elif command == 'inventory':
         print("You are holding:")
         if len(inventory) == 0:
             print('  No items')
         else:
-            for item in inventory:
-                print(f'  {item}')
-        return
-    # elif words[0] == 'take':
-    #     response, addr = client_socket.recv(1024)
-    #     print(response.decode())
-    #     words = response.decode().split()
-    #     if (len(words) == 2) and (words[1] == 'taken'):
-    #         inventory.append(words[0])
-    # elif words[0] == 'drop':
-    #     response, addr = client_socket.recvfrom(1024)
-    #     print(response.decode())
-    #     inventory.remove(words[1])
-    # else:
-    #     response, addr = client_socket.recvfrom(1024)
-    #     print(response.decode())
+            for item, count in inventory.items():
+                print(f'  {describe_items(count, item)}')
+        return
+
+    # Send command to server, if it isn't a local only one.
+
+    send_command(command)
 
 
 # Our main function.
@@ -150,6 +690,13 @@ def main():
     global client_socket
     global client_selector
     global server
+    global room_name
+    global input_file
+    global batch
+    global window
+    global quiet
+    global started
+    global binary
 
     # Register our signal handler for shutting down.
 
@@ -158,7 +705,14 @@ def main():
     # Check command line arguments to retrieve a URL.
     parser = argparse.ArgumentParser()
     parser.add_argument("name", help="name for the player in the game")
-    parser.add_argument("server", help="URL indicating server location in form of room://host:port")
+    parser.add_argument("server", help="URL indicating server location in form of room://host:port, "
+                                           "or room://host:port/room for a world host")
+    # Running headless from a script of commands, one per line
+    parser.add_argument("--script", help="file of commands to run instead of reading what's typed, - for stdin")
+    parser.add_argument("--window", type=int, default=window,
+                        help="commands a script may have in flight at once")
+    parser.add_argument("--quiet", action='store_true', help="don't print what the room says when running a script")
+    parser.add_argument("--binary", action='store_true', help="talk to the room in binary rather than text")
     args = parser.parse_args()
 
     # Check the URL passed in and make sure it's valid.  If so, keep track of
@@ -171,10 +725,22 @@ def main():
         host = server_address.hostname
         port = server_address.port
         server = (host, port)
+        room_name = server_address.path.lstrip('/') or None
     except ValueError:
         print('Error:  Invalid server.  Enter a URL of the form:  room://host:port')
         sys.exit(1)
     name = args.name
+    binary = args.binary
+    if args.script is not None:
+        batch = True
+        window = max(args.window, 1)
+        quiet = args.quiet
+        if args.script != '-':
+            try:
+                input_file = open(args.script, 'rb')
+            except OSError as error:
+                print(f'Error: Could not open script {args.script}: {error}')
+                sys.exit(1)
 
     # Connect to room, send message to verify
 
@@ -184,15 +750,27 @@ def main():
 
     client_socket.setblocking(False)
     client_selector.register(client_socket, selectors.EVENT_READ, handle_data_from_server)
-    client_selector.register(sys.stdin, selectors.EVENT_READ, do_prompt)
+    request_exits()
+    # Regular files are always ready to read and can't be waited on, so a script in
+    # one is read as it's needed instead.
+    if not stat.S_ISREG(os.fstat(input_file.fileno()).st_mode):
+        client_selector.register(input_file, selectors.EVENT_READ, handle_keyboard_input)
+    elif not batch:
+        while not input_done:
+            handle_keyboard_input(None, selectors.EVENT_READ)
     # We now loop forever, sending commands to the server and reporting results
 
-    do_prompt()
+    if batch:
+        started = time.perf_counter()
+        run_script()
+    else:
+        do_prompt()
     while True:
-        events = client_selector.select()
+        events = client_selector.select(IDLE_TIMEOUT if neighbours else None)
         for key, mask in events:
             callback = key.data
             callback(key.fileobj, mask)
+        evict_neighbours()
     client_selector.close()
 if __name__ == '__main__':
     main()
@@ -0,0 +1,35 @@
+from commands import register, Reply, Event, Tell
+
+# Commands beyond the basic ones.  Each registers itself with the room's command table
+# when this module is imported, so adding a command means adding a handler here.
+
+
+# Find another player in the same room by name.
+
+def find_occupant(session, name):
+    other = session.room.occupants.get(name)
+    return None if other is session else other
+
+
+# Say something to one other player in the room, without anyone else hearing it.
+
+@register('whisper')
+def whisper_command(session, command):
+    if len(command.args) < 2:
+        return [Reply("Invalid command")]
+    target = find_occupant(session, command.args[0])
+    if target is None:
+        return [Reply('There is nobody called {} here.'.format(command.args[0]))]
+    text = command.text.split(None, 1)[1]
+    return [Tell(target, '{} whispers \"{}\"'.format(session.name, text)),
+            Reply('You whisper to {} \"{}\".'.format(target.name, text))]
+
+
+# Act something out for the rest of the room, as in "emote waves".
+
+@register('emote', chatter=True)
+def emote_command(session, command):
+    if not command.args:
+        return [Reply("Invalid command")]
+    text = '{} {}'.format(session.name, command.text)
+    return [Event(session.room, text), Reply(text)]
@@ -0,0 +1,81 @@
+import struct
+
+# Every message on the wire is sent as a frame: a one byte kind followed by the
+# length of the payload, then the payload itself.
+
+HEADER = struct.Struct('!BI')
+
+# Kinds of frame.  Players send commands, and the room answers every command with
+# exactly one reply.  Anything else the room sends (other players joining, leaving
+# or talking) is an event, so clients can pipeline commands and still match replies.
+
+KIND_COMMAND = 0
+KIND_REPLY = 1
+KIND_EVENT = 2
+
+# The same three kinds again for players who joined with +binary and send and receive
+# binary messages (see binary.py) rather than text.
+
+KIND_BINARY_COMMAND = 3
+KIND_BINARY_REPLY = 4
+KIND_BINARY_EVENT = 5
+
+# An empty frame either side may send to show it's still there.  With --heartbeat the
+# room sends one to players it hasn't heard from for a while, and players answer with
+# one.  Heartbeats are never replied to as commands are.
+
+KIND_HEARTBEAT = 6
+
+# A batch of shouts and channel messages passed between room processes over a link (see
+# federation.py).  Links are never replied to.
+
+KIND_LINK = 7
+
+# The first frame the room process opening a link sends on it, saying which port it
+# serves players on.  Batches are only taken from links that have sent one.
+
+KIND_LINK_HELLO = 8
+
+# The reply to anything the room turns away because it's too busy: a connection over
+# the session limit, or a command from a player sending too many too quickly.
+
+SERVER_BUSY = 'Server busy, try again later.'
+
+# Largest payload we will accept in one frame, so a bad peer can't make us buffer forever.
+
+MAX_FRAME = 64 * 1024
+
+
+# Raised when a peer sends something that can't be a valid frame.
+
+class FrameError(Exception):
+    pass
+
+
+# Wrap a message up in a frame ready to be sent.
+
+def frame_message(message, kind=KIND_COMMAND):
+    if isinstance(message, str):
+        message = message.encode()
+    return HEADER.pack(kind, len(message)) + message
+
+
+# Pull every complete frame out of a receive buffer, leaving any partial frame
+# in the buffer until the rest of it arrives.  Returns a list of (kind, payload).
+
+def unframe_messages(buffer):
+    frames = []
+    offset = 0
+    available = len(buffer)
+    while available - offset >= HEADER.size:
+        kind, length = HEADER.unpack_from(buffer, offset)
+        if length > MAX_FRAME:
+            raise FrameError('Frame of {} bytes is too large'.format(length))
+        end = offset + HEADER.size + length
+        if end > available:
+            break
+        frames.append((kind, bytes(buffer[offset + HEADER.size:end])))
+        offset = end
+    if offset:
+        del buffer[:offset]
+    return frames
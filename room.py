@@ -1,33 +1,307 @@
+import asyncio
+import base64
+import errno
+import os
 import selectors
 import socket
 import signal
 import sys
 import argparse
-from urllib.parse import urlparse
-
-# Saved information on the room.
-
-name = ''
-description = ''
-items = []
+import json
+import subprocess
+import time
+from collections import deque
+import zlib
+from itertools import islice
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+from protocol import frame_message, unframe_messages, FrameError, HEADER, KIND_REPLY, KIND_EVENT, \
+    KIND_BINARY_COMMAND, KIND_BINARY_REPLY, KIND_BINARY_EVENT, KIND_HEARTBEAT, KIND_LINK, KIND_LINK_HELLO, \
+    SERVER_BUSY
+from binary import NameTable, decode_command, encode_text, encode_items, encode_exit, encode_event, \
+    REPLY_TEXT, EVENT_TEXT, EVENT_ENTERED, EVENT_LEFT, EVENT_SAID, ITEM_TAKEN, ITEM_DROPPED, ITEM_REFUSED, \
+    ITEM_VERBS
+from fdpass import send_fds, recv_fds, send_bundle, recv_bundle
+import metrics
+import plugins
+from admission import TokenBucket
+from timers import TimerWheel
+from federation import SeenMessages, Link, LINK_RETRY, LINK_RATE, new_message_id, encode_message, batch_frames, \
+    decode_batch, hello_frame, decode_hello
+from commands import parse_command, register, handlers, Reply, Summary, Look, Items, ExitReply, Event, Tell, \
+    ChannelEvent, Relay
+from journal import Journal, load_state
+from itemstore import make_store, parse_item_counts, describe_items, remove_items, add_items, GIFT_MARK
+import world as worlds
+from world import parse_exit
 
 # Declaring Selector and boolean for while-loop
 serverSel = selectors.DefaultSelector()
 
 keep_running = True
 
-# Room Connection order: NORTH, SOUTH, EAST, WEST, UP, DOWN
-# Order of tuple contents: direction, hostname, int(port)
-adjacent_rooms = []
-
 # Constant list used for checking if a movement command was called
 DIRECTIONS = ['NORTH', 'SOUTH', 'EAST', 'WEST', 'UP', 'DOWN']
-# List of clients currently in the room.
 
-client_list = []
+# Most changes each room remembers.  Players asking for changes since an older version
+# get the whole room again.
+
+CHANGE_LOG_SIZE = 256
+
+# Saved information on a room.  Exits map a lower case direction either to the name of
+# another room served by this process, or to a (hostname, port, room name) tuple for a
+# room served somewhere else.  The room name of a remote exit is None when the other
+# end only serves one room.
+#
+# Versions start from when the room was made, in microseconds, so a version a player
+# was given before a restart, or before the room was last put away, is never mistaken
+# for one after it.
+
+class Room:
+    __slots__ = ('name', 'description', 'items', 'exits', 'occupants', 'version', 'summary',
+                 'summary_frame', 'players', 'changes', 'subscribers', 'pushed')
+
+    def __init__(self, name, description, items):
+        self.name = name
+        self.description = description
+        # Count of each item in the room, in the order they first turned up.
+        self.items = make_store(items)
+        self.exits = {}
+        # Sessions of the players currently in the room, keyed by player name.
+        self.occupants = {}
+        # Bumped with every change to the items, exits or players in the room, each of
+        # which is kept in the change log as (version, line) until it ages out.  The log
+        # is only made once the room first changes.
+        self.version = time.time_ns() // 1000
+        self.changes = None
+        # Players subscribed to the room's changes, and the version they've been sent up to.
+        self.subscribers = set()
+        self.pushed = self.version
+        # Rendered summary, and the summary as a reply frame, built when first needed
+        # after a change.
+        self.summary = None
+        self.summary_frame = None
+        # Rendered list of other players for each player in the room, only cleared
+        # when someone comes or goes.
+        self.players = {}
+
+
+# Every room served by this process that players are using, keyed by name, and the room
+# players join by default.
+
+rooms = {}
+start_room = None
+
+# The world file the rooms come from, if there is one.  Its rooms are only made into Rooms
+# when first needed, and put away again once nobody is using them.
+
+world = None
+
+# Everything we know about one connected socket.  A session exists from the moment a
+# socket is accepted; it only gets a name, and counts as a player in the room, once
+# it has joined.
+
+class Session:
+    __slots__ = ('connection', 'transport', 'fd', 'name', 'room', 'address', 'receive_buffer',
+                 'send_buffer', 'pending', 'paused', 'closing', 'handoff', 'commands', 'bytes_in',
+                 'bytes_out', 'binary', 'reply_binary', 'sent_names', 'received_names', 'bucket',
+                 'last_seen', 'subscribed', 'link', 'channels', 'peer')
+
+    def __init__(self, connection, address, transport=None):
+        self.connection = connection
+        # Set when the session is served by the asyncio engine, which does its own buffering.
+        self.transport = transport
+        self.fd = connection.fileno()
+        self.name = None
+        self.room = None
+        self.address = address
+        self.receive_buffer = bytearray()
+        # Frames waiting to be sent.  Broadcasts put the same bytes object in every
+        # recipient's queue rather than copying it, and pending counts the bytes queued.
+        self.send_buffer = deque()
+        self.pending = 0
+        # Not reading commands until the send buffer drains.
+        self.paused = False
+        # Closing as soon as everything queued has been sent.
+        self.closing = False
+        # Where to hand the session once the current command is done, if its room
+        # belongs to another worker: (shard, action).
+        self.handoff = None
+        self.commands = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Set once the player has joined with +binary.  Events then go to them in binary,
+        # as do replies to the binary commands they send, and the names each side has
+        # sent are numbered.
+        self.binary = False
+        self.reply_binary = False
+        self.sent_names = None
+        self.received_names = None
+        # Commands the player may send before being told the server is busy, with --rate.
+        self.bucket = TokenBucket(command_rate, command_burst) if command_rate else None
+        # When the player last sent anything, for heartbeats and reaping idle sessions.
+        self.last_seen = time.monotonic()
+        # Whether changes to whichever room the player is in are pushed to them.
+        self.subscribed = False
+        # The link, if this is one we opened to another room process rather than a player.
+        self.link = None
+        # Channels the player is listening to, made when they first listen to one.
+        self.channels = None
+        # The (address, port) of the room process on the other end, if this is a link
+        # another process opened to us.  Its bucket is then for the messages it brings in.
+        self.peer = None
+
+
+# Every session, keyed by the file descriptor of its socket.
+
+sessions_by_fd = {}
+
+# Sessions that have joined a room, keyed by player name.  Names are unique across
+# every room this process serves.
+
+sessions_by_name = {}
+
+# Opcode starting a binary reply made up of text, such as a room summary.
+
+BINARY_TEXT_REPLY = bytes([REPLY_TEXT])
+
+# Sessions with frames queued since the last flush.  Everything queued during a tick is
+# written to each socket with a single sendmsg() at the end of the tick.
+
+flush_sessions = set()
+
+# Rooms that have changed since their subscribers were last sent the changes.
+
+changed_rooms = set()
+
+# Length of a tick in seconds.  With a tick of 0 sockets are flushed at the end of every
+# pass of the loop; longer ticks trade latency for fewer, larger writes.
+
+tick_length = 0.0
+
+# Most buffers sendmsg() will take in one call.
+
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+# Instrumentation.  Commands are timed and counted under the name of their handler, or
+# as "other", so a player typing nonsense can't create new metrics.
+
+metrics.describe('room_commands_total', 'Commands processed, by command.', 'command')
+metrics.describe('room_command_seconds', 'Time taken to process a command, by command.', 'command')
+metrics.describe('room_connections_total', 'Player connections accepted.')
+metrics.describe('room_bytes_received_total', 'Bytes received from players.')
+metrics.describe('room_bytes_sent_total', 'Bytes sent to players.')
+metrics.describe('room_loop_seconds', 'Time spent handling the events of one pass of the event loop.')
+metrics.describe('room_reaped_total', 'Sessions dropped after sending nothing for the idle timeout.')
+metrics.describe('room_shed_total', 'Connections and commands turned away as the server was busy, by reason.',
+                 'reason')
+metrics.describe('room_link_messages_total', 'Shouts and channel messages passed over links to and from other '
+                 'room processes, by what became of them.', 'result')
+metrics.describe('room_link_frames_total', 'Batches of messages written to links.')
+
+# Connections to the stats port waiting for their request to arrive, with what they've sent so far.
+
+stats_requests = {}
+
+# Sessions that fell too far behind or failed, to be dropped at the end of the loop pass.
+
+dropped_sessions = set()
+
+# Durable state, kept with --state.  The journal, if any, what each player is carrying
+# and the room each player was last in, both by name, so a player who lost their
+# connection or outlived a restart comes back where they were with what they held.
+
+journal = None
+holdings = {}
+places = {}
+
+# Records to journal between snapshots.
+
+snapshot_every = 10000
+
+# Where the journal is kept and how often it's synced, to open it again if need be.
+
+state_directory = None
+sync_interval = 0.1
+
+# Sharding.  With --workers, a supervisor forks that many worker processes which all
+# accept players on the same port.  Each room belongs to exactly one worker, and a
+# player's socket is handed over to the worker that owns their room when they join
+# it or walk into it, so everything that happens in a room stays in one process.
+
+shard_index = 0
+shard_count = 1
+
+# Sending end of every worker's handoff socket, by shard, and the receiving end of ours.
+
+shard_links = []
+shard_inbox = None
+
+# Largest handoff message we try to send.  Anything bigger can't go over the socket.
+
+MAX_HANDOFF = 128 * 1024
+
+# Send buffer limits in bytes.  Above the high watermark a player's commands aren't read
+# until their buffer falls back under the low watermark, and past the maximum they're dropped.
+high_watermark = 64 * 1024
+low_watermark = 16 * 1024
+max_buffer = 1024 * 1024
 
-# Used for storing connected sockets
-connections = []
+# Admission control.  At most max_sessions connections are served at once (0 for no
+# limit), each player may send command_rate commands a second after a burst of
+# command_burst, and with --max-fanout the events sent to players share a budget a
+# second, spent by everything but only enforced on commands that are just chatter.
+max_sessions = 0
+command_rate = 0.0
+command_burst = 20
+fanout_bucket = None
+BUSY_REPLY = frame_message(SERVER_BUSY, KIND_REPLY)
+
+# Connections turned away, kept open a moment so the busy reply isn't lost: socket (or
+# transport) -> when it's closed regardless.  At most MAX_REJECTED are kept at once,
+# oldest closed first, so a storm of idle connections can't use up our descriptors.
+
+REJECT_GRACE = 1.0
+MAX_REJECTED = 64
+rejected_connections = {}
+
+# A descriptor held in reserve.  When we run out, it's given up for long enough to
+# accept and close the connection waiting, rather than leaving it to wake the loop forever.
+
+spare_fd = None
+
+# Liveness.  With --heartbeat, players quiet for that many seconds are sent a heartbeat,
+# and with --idle-timeout players who have sent nothing at all for that long, heartbeats
+# included, are dropped as gone.  Each session has one timer in the wheel at a time,
+# set for the next moment it could need either, and checked against last_seen when it
+# goes off, so traffic never has to touch the wheel.
+timer_wheel = None
+heartbeat_interval = 0.0
+idle_timeout = 0.0
+HEARTBEAT_FRAME = frame_message(b'', KIND_HEARTBEAT)
+
+# Federation with other room processes (see federation.py): the links we've opened to
+# them, keyed by (hostname, port), the links with messages queued this tick, and the
+# rooms here that each recent message has reached.
+
+links = {}
+pending_links = set()
+seen_messages = SeenMessages()
+
+# The port we serve players on, which our links announce, and the (address, port) of
+# every room process allowed to open a link to us, with the messages a second each may
+# bring in.
+
+room_port = None
+link_peers = set()
+link_rate = LINK_RATE
+
+# Most exits a shout passes through, and a channel message.
+
+shout_range = 3
+channel_range = 8
 
 
 # Signal handler for graceful exiting.
@@ -37,219 +311,2185 @@ def signal_handler(sig, frame):
     sys.exit(0)
 
 
-# Confirm that movement to another room is possible
-def server_get_room(direction):
-    global adjacent_rooms
-    global DIRECTIONS
+# Confirm that movement to another room is possible, returning where the exit leads or None.
 
-    for adjacent_server in adjacent_rooms:
-        if adjacent_server[0].upper() == direction.upper():
-            return '{} {} {}'.format(adjacent_server[0], adjacent_server[1], adjacent_server[2])
-        else:
-            if direction.upper() != "UP" and direction.upper() != "DOWN":
-                return 'There is no hatch leading {}.'.format(direction)
-            else:
-                return 'There is no door to the {}.'.format(direction)
+def server_get_room(room, direction):
+    return room.exits.get(direction.lower())
 
 
-# Search the client list for a particular player.
+# Explain to a player that there's no way out of the room in some direction.
 
-def client_search(player):
-    for reg in client_list:
-        if reg[0] == player:
-            return reg[1]
-    return None
+def no_exit_message(direction):
+    if direction.upper() == "UP" or direction.upper() == "DOWN":
+        return 'There is no hatch leading {}.'.format(direction)
+    else:
+        return 'There is no door to the {}.'.format(direction)
 
 
-# Search the client list for a particular player by their address.
+# Find a room served by this process by name, making it from the world file the first time
+# it's needed.  Returns None if there's no such room.
 
-def client_search_by_address(address):
-    for reg in client_list:
-        if reg[1] == address:
-            return reg[0]
-    return None
+def find_room(name):
+    room = rooms.get(name)
+    if room is not None or world is None:
+        return room
+    room = make_room(name)
+    if room is not None:
+        rooms[name] = room
+        note_room(room)
+    return room
 
 
-# Add a player to the client list.
+# Make a room from the world file as the file has it, without keeping it.  Returns None if
+# the world file has no such room.
 
-def client_add(player, address):
-    registration = (player, address)
-    client_list.append(registration)
+def make_room(name):
+    number = world.index.get(name)
+    if number is None:
+        return None
+    room = Room(name, world.descriptions[number], world.items[number])
+    room.exits = world.room_exits(number)
+    return room
 
 
-# Remove a client when disconnected.
+# Whether this process serves a room by the given name, without making it.
 
-def client_remove(player):
-    for reg in client_list:
-        if reg[0] == player:
-            client_list.remove(reg)
-            break
+def room_exists(name):
+    return name in rooms or (world is not None and name in world)
 
 
-# Summarize the room into text.
+# Put a room from the world file away if nobody is in it or watching it and it's back the
+# way the world file has it, so it can be made again from the file when next needed.
+
+def release_room(room):
+    if room is start_room or room.occupants or room.subscribers or world is None:
+        return
+    number = world.index.get(room.name)
+    if number is not None and room.items == make_store(world.items[number]):
+        del rooms[room.name]
+        changed_rooms.discard(room)
+
+
+# Find the session of a player by name.
+
+def session_search(player):
+    return sessions_by_name.get(player)
+
+
+# Put a session in a room under the given player name.
+
+def session_join(session, player, room):
+    session.name = player
+    session.room = room
+    sessions_by_name[player] = session
+    room.occupants[player] = session
+    room.players.clear()
+    log_changes(room, '> ' + player)
+    if session.subscribed:
+        subscribe(session, room)
+
+
+# Take a session's player out of the game.
+
+def session_leave(session):
+    if session.name is not None and sessions_by_name.get(session.name) is session:
+        del sessions_by_name[session.name]
+        del session.room.occupants[session.name]
+        session.room.players.clear()
+        session.room.subscribers.discard(session)
+        log_changes(session.room, '< ' + session.name)
+        release_room(session.room)
+    session.name = None
+    session.room = None
+
+
+# Move a player from the room they're in to another one.
+
+def session_move(session, room):
+    del session.room.occupants[session.name]
+    session.room.players.clear()
+    session.room.subscribers.discard(session)
+    log_changes(session.room, '< ' + session.name)
+    release_room(session.room)
+    session.room = room
+    room.occupants[session.name] = session
+    room.players.clear()
+    log_changes(room, '> ' + session.name)
+    if session.subscribed:
+        subscribe(session, room)
+
+
+# Change the name a player goes by.
+
+def session_rename(session, player):
+    old_name = session.name
+    room = session.room
+    del sessions_by_name[old_name]
+    del room.occupants[old_name]
+    session.name = player
+    sessions_by_name[player] = session
+    room.occupants[player] = session
+    room.players.clear()
+    log_changes(room, '< ' + old_name, '> ' + player)
+    return old_name
+
+
+# Journal a player taking items and keep track of what they hold.
+
+def note_taken(session, item, count):
+    if journal is not None:
+        journal.record('t', session.room.name, item, count, session.name)
+        add_items(holdings.setdefault(session.name, make_store()), item, count)
+
+
+# Journal a player dropping items.
+
+def note_dropped(session, item, count):
+    if journal is not None:
+        journal.record('d', session.room.name, item, count, session.name)
+        held = holdings.get(session.name)
+        if held is not None:
+            remove_items(held, item, min(count, held.get(item, 0)))
+            if not held:
+                del holdings[session.name]
+
+
+# Journal the items in a room just made from the world file, so replaying the journal
+# starts it from what the world file had rather than from nothing.  Rooms are only made
+# when they aren't in the last snapshot or have been put away unchanged since.
+
+def note_room(room):
+    if journal is not None:
+        journal.record('r', room.name, dict(room.items))
+
+
+# Journal a player arriving in a room.
+
+def note_place(session):
+    if journal is not None:
+        journal.record('j', session.name, session.room.name)
+        places[session.name] = session.room.name
+
+
+# Journal a player handing items to another player.
+
+def note_given(session, receiver, item, count):
+    if journal is not None:
+        journal.record('g', session.name, receiver.name, item, count)
+        held = holdings.get(session.name)
+        if held is not None:
+            remove_items(held, item, min(count, held.get(item, 0)))
+            if not held:
+                del holdings[session.name]
+        add_items(holdings.setdefault(receiver.name, make_store()), item, count)
+
 
-def summarize_room():
-    global name
-    global description
-    global items
-    global adjacent_rooms
-    global client_list
+# Journal a player changing their name.
 
+def note_renamed(old_name, new_name):
+    if journal is not None:
+        journal.record('n', old_name, new_name)
+        if old_name in holdings:
+            holdings[new_name] = holdings.pop(old_name)
+        if old_name in places:
+            places[new_name] = places.pop(old_name)
+
+
+# Journal a player leaving the game.
+
+def note_left(player):
+    if journal is not None:
+        journal.record('x', player)
+        holdings.pop(player, None)
+        places.pop(player, None)
+
+
+# Everything the journal keeps, copied out for a snapshot.
+
+def current_state():
+    return {'rooms': {room.name: dict(room.items) for room in rooms.values()},
+            'holdings': {player: dict(held) for player, held in holdings.items()},
+            'places': dict(places)}
+
+
+# Put back the state saved by an earlier run.  Rooms no longer in the world are skipped,
+# as are rooms from the world file that are just as the file has them.
+
+def restore_state(state):
+    for name, items in state['rooms'].items():
+        number = world.index.get(name) if world is not None else None
+        if number is not None and make_store(items) == make_store(world.items[number]):
+            continue
+        room = find_room(name)
+        if room is not None:
+            room.items = make_store(items)
+            room_changed(room)
+    holdings.update((player, make_store(held)) for player, held in state['holdings'].items())
+    places.update(state['places'])
+
+
+# Hand this loop pass's changes to the journal, snapshotting once enough have built up.
+
+def save_changes():
+    if journal is not None:
+        journal.flush()
+        if journal.records >= snapshot_every:
+            journal.snapshot(current_state())
+
+
+# Save a final snapshot and wait for the journal to be written.
+
+def close_journal():
+    if journal is not None:
+        journal.snapshot(current_state())
+        journal.close()
+
+
+# Summarize the room into text.
+
+def summarize_room(room):
     # Putting room name and description into a string
-    summary = name + '\n\n' + description + '\n'
+    summary = [room.name, '\n\n', room.description, '\n']
 
     # Loop for adding available connections
-    for room in adjacent_rooms:
-        if room[0] != "":
-            # For rooms going in cardinal directions
-            if room[0] != "up" or room[0] != "down":
-                summary += 'A doorway leads away from the room to the ' + room[0] + '.\n'
-            # For rooms going up/ down
-            else:
-                summary += 'A hatch leads out of the room going ' + room[0] + '.\n'
-    summary += '\n'
+    for direction in room.exits:
+        # For rooms going in cardinal directions
+        if direction != "up" and direction != "down":
+            summary.append('A doorway leads away from the room to the ' + direction + '.\n')
+        # For rooms going up/ down
+        else:
+            summary.append('A hatch leads out of the room going ' + direction + '.\n')
+    summary.append('\n')
 
-    # Adding room's items to summary
+    # Adding room's items to summary, one line per kind of item
+    items = room.items
     if len(items) == 0:
-        summary += "The room is empty.\n"
-    elif len(items) == 1:
-        summary += "In this room, there is:\n"
-        summary += f'  {items[0]}\n'
+        summary.append("The room is empty.\n")
     else:
-        summary += "In this room, there are:\n"
-        for item in items:
-            summary += f'  {item}\n'
+        if len(items) == 1 and next(iter(items.values())) == 1:
+            summary.append("In this room, there is:\n")
+        else:
+            summary.append("In this room, there are:\n")
+        for item, count in items.items():
+            summary.append(f'  {describe_items(count, item)}\n')
 
     # Returning the completed summary
-    return summary
+    return ''.join(summary)
+
+
+# Mark a room's items or exits as changed, so its summary gets rendered again when next needed.
+
+def room_changed(room, *changes):
+    room.summary = None
+    room.summary_frame = None
+    log_changes(room, *changes)
+
+
+# Note changes to a room in its change log, each under the next version.  Subscribers
+# are sent them at the end of the tick.
+
+def log_changes(room, *changes):
+    if not changes:
+        return
+    if room.changes is None:
+        room.changes = deque(maxlen=CHANGE_LOG_SIZE)
+    for change in changes:
+        room.version += 1
+        room.changes.append((room.version, change))
+    if room.subscribers:
+        changed_rooms.add(room)
+
+
+# The lines of every change to a room after the given version, or None if some of them
+# have aged out of the log (or the version isn't one of the room's).
+
+def changes_since(room, version):
+    if version == room.version:
+        return []
+    log = room.changes
+    if log is None or version > room.version or version < log[0][0] - 1:
+        return None
+    return [change for logged, change in islice(log, version + 1 - log[0][0], None)]
+
+
+# What a player is told about their room's changes since a version they know: just the
+# changes, or the whole room again if they go back too far.
+
+def changes_reply(session, version):
+    room = session.room
+    changes = changes_since(room, version) if version is not None else None
+    if changes is None:
+        return b'Version %d full\n' % room.version + cached_summary(room) + cached_players(session)
+    return '\n'.join(['Version {} since {}'.format(room.version, version)] + changes)
+
+
+# Start pushing a room's changes to a player.  Anything the other subscribers haven't
+# been sent yet goes out first, so the player only hears about changes from now on.
+
+def subscribe(session, room):
+    if room.version != room.pushed:
+        push_changes(room)
+    room.subscribers.add(session)
+
+
+# Send every subscriber the changes to their room since they were last sent any.  They
+# all share one frame, unless so much has changed that they each need the whole room.
+
+def push_changes(room):
+    changes = changes_since(room, room.pushed)
+    if changes is None:
+        for session in room.subscribers:
+            write_tell(session, Tell(session, changes_reply(session, None)))
+    elif changes:
+        message = '\n'.join(['Version {} since {}'.format(room.version, room.pushed)] + changes)
+        frame = frame_message(message, KIND_EVENT)
+        binary_frame = None
+        for session in room.subscribers:
+            if not session.binary:
+                queue_frame(session, frame)
+            else:
+                if binary_frame is None:
+                    binary_frame = frame_message(encode_text(EVENT_TEXT, message), KIND_BINARY_EVENT)
+                queue_frame(session, binary_frame)
+    room.pushed = room.version
+
+
+def push_all_changes():
+    while changed_rooms:
+        push_changes(changed_rooms.pop())
+
+
+# The room summary as ready-to-send bytes, without the final newline.
+
+def cached_summary(room):
+    if room.summary is None:
+        room.summary = summarize_room(room)[:-1].encode()
+    return room.summary
+
+
+# The room summary as a reply frame, for players arriving in the room.
+
+def summary_reply(room):
+    if room.summary_frame is None:
+        room.summary_frame = frame_message(cached_summary(room), KIND_REPLY)
+    return room.summary_frame
 
 
 # Function for printing the list of player's in the room
-def get_other_players(address):
-    summary = ""
+def get_other_players(session):
+    others = [player for player in session.room.occupants if player != session.name]
     # Adding list of other players/ clients in the room to the summary
-    if len(client_list) == 1:
-        summary += "There are no other players in this room."
-    elif len(client_list) == 2:
-        summary += "There is one other player in this room: "
-        for client in client_list:
-            if client[1] != address:
-                summary += '{}.\n'.format(client[0])
+    if len(others) == 0:
+        return "There are no other players in this room.\n"
+    elif len(others) == 1:
+        return "There is one other player in this room: {}.\n".format(others[0])
+    else:
+        summary = 'The other players in this room are: \n'
+        for player in others:
+            summary += '{}\n'.format(player)
+        return summary
+
+
+# The players section of a look for one player, as bytes, rendered once per change of occupants.
+
+def cached_players(session):
+    players = session.room.players.get(session.name)
+    if players is None:
+        players = ('\n\n' + get_other_players(session)[:-1]).encode()
+        session.room.players[session.name] = players
+    return players
+
+
+# The full reply to a look: the room summary followed by who else is here.
+
+def look_reply(session):
+    summary = cached_summary(session.room)
+    players = cached_players(session)
+    if session.reply_binary:
+        return (HEADER.pack(KIND_BINARY_REPLY, len(BINARY_TEXT_REPLY) + len(summary) + len(players)),
+                BINARY_TEXT_REPLY, summary, players)
+    return (HEADER.pack(KIND_REPLY, len(summary) + len(players)), summary, players)
+
+
+# Send a player a room's summary as the reply to their command.
+
+def send_summary(session, room):
+    if session.reply_binary:
+        summary = cached_summary(room)
+        queue_frame(session, HEADER.pack(KIND_BINARY_REPLY, len(BINARY_TEXT_REPLY) + len(summary)),
+                    BINARY_TEXT_REPLY, summary)
     else:
-        summary += 'The other players in this room are: \n'
-        for client in client_list:
-            if client[1] != address:
-                summary += '{}\n'.format(client[0])
+        queue_frame(session, summary_reply(room))
+
+
+# The reply to joining: the room summary, along with anything the player was still
+# carrying when they were last here.
+
+def join_response(session):
+    held = holdings.get(session.name)
+    if not held:
+        return Summary(session.room)
+    lines = ['You are still carrying what you had when you left:']
+    lines += [f'{describe_items(count, item)} taken' for item, count in held.items()]
+    return Reply(cached_summary(session.room) + ('\n\n' + '\n'.join(lines)).encode())
 
 
 # Print a room's description.
 
-def print_room_summary():
-    print(summarize_room()[:-1])
+def print_room_summary(room):
+    print(summarize_room(room)[:-1])
 
 
 # Function for accepting new connections
 def accept(socket, mask):
     global serverSel
-    client_connection, address = socket.accept()
-    print("New socket registered from address {}".format(address))
+    try:
+        client_connection, address = socket.accept()
+    except OSError as error:
+        if error.errno in (errno.EMFILE, errno.ENFILE):
+            shed_connection(socket)
+        return
     client_connection.setblocking(False)
-    serverSel.register(client_connection, selectors.EVENT_READ, process_message)
+    if max_sessions and len(sessions_by_fd) >= max_sessions:
+        reject_connection(client_connection)
+        return
+    print("New socket registered from address {}".format(address))
+    metrics.increment('room_connections_total')
+    session = Session(client_connection, address)
+    sessions_by_fd[session.fd] = session
+    watch_session(session)
+    serverSel.register(client_connection, selectors.EVENT_READ, handle_connection)
 
 
-# Process incoming message.
+# Turn away a connection over the session limit.  The player's join is answered with the
+# busy reply, sent straight away, and the socket is closed once whatever the player sent
+# has been read, so closing it doesn't reset the connection and lose the reply.
 
-def process_message(connection, addr):
+def reject_connection(connection):
     global serverSel
-    global connections
-    # Parse the message.
-    message = connection.recv(1024).decode()
-    words = message.split()
-
-    # If player is joining the server, add them to the list of players.
-
-    if (words[0] == 'join'):
-        if (len(words) == 2):
-            client_add(words[1], addr)
-            connections.append(connection)
-
-            print(f'User {words[1]} joined from address {addr}')
-            response = 'User {} entered the room.'.format(client_search_by_address(addr))
-            for client in connections:
-                if client is not connection:
-                    client.send(response.encode())
-            connection.send(summarize_room()[:-1].encode())
-        else:
-            connection.send("Invalid command".encode())
-
-    # If player is leaving the server. remove them from the list of players.
-
-    elif (message == 'exit'):
-        response = 'User {} has left the server'.format(client_search_by_address(addr))
-        client_remove(client_search_by_address(addr))
-        connections.remove(connection)
-        for client in connections:
-            if client is not connection:
-                client.send(response.encode())
-        connection.send('Goodbye'.encode())
+    metrics.increment('room_shed_total', label='sessions')
+    try:
+        connection.send(BUSY_REPLY)
+        connection.shutdown(socket.SHUT_WR)
+    except OSError:
         connection.close()
+        return
+    if len(rejected_connections) >= MAX_REJECTED:
+        close_rejected(next(iter(rejected_connections)))
+    rejected_connections[connection] = time.monotonic() + REJECT_GRACE
+    serverSel.register(connection, selectors.EVENT_READ, read_rejected)
+
+
+def read_rejected(connection, mask):
+    try:
+        connection.recv(4096)
+    except OSError:
+        pass
+    close_rejected(connection)
 
-    # If player looks around, give them the room summary.
 
-    elif (message == 'look'):
-        summary = summarize_room()[:-1]
-        # Adding client list to summary
-        summary += get_other_players(addr)
-        connection.send(summary[:-1].encode())
+def close_rejected(connection):
+    global serverSel
+    del rejected_connections[connection]
+    serverSel.unregister(connection)
+    connection.close()
+
+
+# Close turned away connections that have had their grace period without sending anything.
+
+def expire_rejected():
+    now = time.monotonic()
+    while rejected_connections:
+        connection, deadline = next(iter(rejected_connections.items()))
+        if deadline > now:
+            break
+        close_rejected(connection)
+
 
-    # If player takes an item, make sure it is here and give it to the player.
+# Accept and close a connection while out of descriptors, using the one held in reserve.
 
-    elif (words[0] == 'take'):
-        if (len(words) == 2):
-            if (words[1] in items):
-                items.remove(words[1])
-                connection.send(f'{words[1]} taken'.encode())
+def shed_connection(listener):
+    global spare_fd
+    metrics.increment('room_shed_total', label='sessions')
+    if spare_fd is None:
+        return
+    os.close(spare_fd)
+    spare_fd = None
+    try:
+        connection, address = listener.accept()
+        connection.close()
+    except OSError:
+        pass
+    try:
+        spare_fd = os.open(os.devnull, os.O_RDONLY)
+    except OSError:
+        pass
+
+
+# Selector callback for player sockets, sending queued data and reading commands as they're ready.
+
+def handle_connection(connection, mask):
+    session = sessions_by_fd[connection.fileno()]
+    if mask & selectors.EVENT_WRITE:
+        flush_session(session)
+    if mask & selectors.EVENT_READ and sessions_by_fd.get(session.fd) is session:
+        process_message(session)
+
+
+# Queue a frame for a session, to go out with everything else queued for it this tick.
+# A frame can be given in several pieces, which are sent as they are without being joined.
+
+def queue_frame(session, *chunks):
+    if session in dropped_sessions or session.connection is None:
+        return
+    session.send_buffer.extend(chunks)
+    session.pending += sum(map(len, chunks))
+    if session.pending > max_buffer:
+        dropped_sessions.add(session)
+        return
+    flush_sessions.add(session)
+
+
+# Send everything queued this tick.
+
+def flush_all():
+    while flush_sessions:
+        session = flush_sessions.pop()
+        if session.connection is not None and session not in dropped_sessions:
+            flush_session(session)
+
+
+# Send as much of a session's queued data as its socket will take, in one system call.
+
+def flush_session(session):
+    buffer = session.send_buffer
+    if session.transport is not None:
+        flush_transport(session)
+        return
+    if buffer:
+        chunks = list(buffer) if len(buffer) <= IOV_MAX else [buffer[index] for index in range(IOV_MAX)]
+        try:
+            sent = session.connection.sendmsg(chunks)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            buffer.clear()
+            session.pending = 0
+            dropped_sessions.add(session)
+            return
+        session.pending -= sent
+        session.bytes_out += sent
+        metrics.increment('room_bytes_sent_total', sent)
+        while sent:
+            chunk = buffer[0]
+            if len(chunk) <= sent:
+                buffer.popleft()
+                sent -= len(chunk)
             else:
-                connection.send(f'{words[1]} cannot be taken in this room'.encode())
+                buffer[0] = memoryview(chunk)[sent:]
+                sent = 0
+    update_interest(session)
+
+
+# Hand everything queued for an asyncio session to its transport in one write.  The
+# transport applies the watermarks itself, through pause_writing and resume_writing.
+
+def flush_transport(session):
+    buffer = session.send_buffer
+    if buffer:
+        session.transport.writelines(buffer)
+        session.bytes_out += session.pending
+        metrics.increment('room_bytes_sent_total', session.pending)
+        buffer.clear()
+        session.pending = 0
+    if session.transport.get_write_buffer_size() > max_buffer:
+        dropped_sessions.add(session)
+    elif session.closing:
+        session.transport.close()
+
+
+# Apply the watermarks to a session and only ask the selector about writes while data is pending.
+
+def update_interest(session):
+    global serverSel
+    pending = session.pending
+
+    if pending > max_buffer:
+        dropped_sessions.add(session)
+        return
+    if pending > high_watermark:
+        session.paused = True
+    elif pending <= low_watermark:
+        session.paused = False
+
+    if session.closing and not pending:
+        close_session(session)
+        return
+
+    events = 0
+    if not session.paused and not session.closing:
+        events |= selectors.EVENT_READ
+    if pending:
+        events |= selectors.EVENT_WRITE
+    if events != serverSel.get_key(session.connection).events:
+        serverSel.modify(session.connection, events, handle_connection)
+
+
+# Send a reply to the player who issued a command.
+
+def send_reply(session, response):
+    if session.reply_binary:
+        queue_frame(session, frame_message(encode_text(REPLY_TEXT, response), KIND_BINARY_REPLY))
+    else:
+        queue_frame(session, frame_message(response, KIND_REPLY))
+
+
+# Send the reply to a take or drop, given (what happened, count, item) for each item.
+
+def send_items(session, results):
+    if session.reply_binary:
+        queue_frame(session, frame_message(encode_items(session.sent_names, results), KIND_BINARY_REPLY))
+    else:
+        send_reply(session, '\n'.join(f'{describe_items(count, item)} {ITEM_VERBS[status]}'
+                                      for status, count, item in results))
+
+
+# Tell a player an exit leads to another server.
+
+def send_exit(session, direction, destination):
+    if session.reply_binary:
+        queue_frame(session, frame_message(encode_exit(direction, *destination), KIND_BINARY_REPLY))
+    else:
+        send_reply(session, describe_exit(direction, destination))
+
+
+# How many players in a room an event from sender goes to: everyone there but them.
+
+def event_fanout(room, sender):
+    if sender is not None and room.occupants.get(sender.name) is sender:
+        return len(room.occupants) - 1
+    return len(room.occupants)
+
+
+# Send an event to every player in a room apart from the one who caused it.  Players
+# using binary get events about a player as (opcode, player, detail) if one is given.
+# Text players all share the one frame, as do binary players sent the text.
+
+def send_event(room, sender, response, event=None):
+    frame = None
+    binary_frame = None
+    if fanout_bucket is not None:
+        fanout_bucket.spend(event_fanout(room, sender))
+    for session in room.occupants.values():
+        if session is sender:
+            continue
+        if not session.binary:
+            if frame is None:
+                frame = frame_message(response, KIND_EVENT)
+            queue_frame(session, frame)
+        elif event is not None:
+            queue_frame(session, frame_message(encode_event(session.sent_names, *event), KIND_BINARY_EVENT))
         else:
-            connection.send("Invalid command".encode())
+            if binary_frame is None:
+                binary_frame = frame_message(encode_text(EVENT_TEXT, response), KIND_BINARY_EVENT)
+            queue_frame(session, binary_frame)
 
-    # If player drops an item, put it in the list of things here.
 
-    elif (words[0] == 'drop'):
-        if (len(words) == 2):
-            items.append(words[1])
+# Forget about a session and close its socket.
 
-            connection.send(f'{words[1]} dropped'.encode())
+def close_session(session):
+    global serverSel
+    del sessions_by_fd[session.fd]
+    session_leave(session)
+    if session.link is not None:
+        link_failed(session.link)
+    dropped_sessions.discard(session)
+    if session.transport is not None:
+        session.transport.abort()
+    else:
+        serverSel.unregister(session.connection)
+        session.connection.close()
+    session.connection = None
+
+
+# Take a player out of the room and let everyone else know they've gone.
+
+def remove_player(session):
+    response = 'User {} has left the server'.format(session.name)
+    event = (EVENT_LEFT, session.name, None)
+    room = session.room
+    session_leave(session)
+    send_event(room, session, response, event)
+
+
+# Drop every player who couldn't keep up or whose socket failed.  Letting the others know
+# can itself push someone over the limit, so keep going until nobody is left to drop.
+
+def drop_sessions():
+    while dropped_sessions:
+        session = dropped_sessions.pop()
+        if session.connection is None:
+            continue
+        print('Dropping connection from address {}'.format(session.address))
+        if session.name is not None:
+            remove_player(session)
+        close_session(session)
+
+
+# Read whatever is waiting on a session's socket and process every complete command in it.
+
+def process_message(session):
+    try:
+        data = session.connection.recv(4096)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        data = b''
+
+    # The player went away without saying goodbye, so treat it as an exit.
+
+    if not data:
+        dropped_sessions.add(session)
+        return
+
+    session.bytes_in += len(data)
+    session.last_seen = time.monotonic()
+    metrics.increment('room_bytes_received_total', len(data))
+    session.receive_buffer += data
+    process_frames(session)
+
+
+# Start keeping an eye on whether a session is still there, if we've been asked to.
+
+def watch_session(session):
+    if timer_wheel is not None:
+        timer_wheel.schedule(min(heartbeat_interval or idle_timeout, idle_timeout or heartbeat_interval),
+                             check_session, session)
+
+
+# Timer callback for a session: drop it if it's been idle too long, send it a heartbeat
+# if it's been quiet, and set the next timer for whenever either could next be due.
+
+def check_session(session):
+    if session.connection is None:
+        return
+    quiet = time.monotonic() - session.last_seen
+    if idle_timeout and quiet >= idle_timeout:
+        print('Reaping idle connection from address {}'.format(session.address))
+        metrics.increment('room_reaped_total')
+        dropped_sessions.add(session)
+        return
+    delay = idle_timeout - quiet if idle_timeout else heartbeat_interval
+    if heartbeat_interval:
+        if quiet >= heartbeat_interval:
+            queue_frame(session, HEARTBEAT_FRAME)
+            delay = min(delay, heartbeat_interval)
         else:
-            connection.send("Invalid command".encode())
+            delay = min(delay, heartbeat_interval - quiet)
+    timer_wheel.schedule(delay, check_session, session)
+
 
-    # If player says something to rest of server, send to other players
-    elif words[0] == 'say':
-        msg = '{} said \"{}\"'.format(client_search_by_address(addr), message[4:-1])
-        for client in connections:
-            if client is not connection:
-                client.send(msg.encode())
-        response = 'You said \"{}\".'.format(message[4:-1])
-        connection.send(response.encode())
+# Process every complete command in a session's receive buffer.
 
-    # If player calls to move to one of adjacent rooms, confirm room connection and move player
-    elif words[0].upper() in DIRECTIONS:
-        msg = server_get_room(words[0])
+def process_frames(session):
+    try:
+        frames = unframe_messages(session.receive_buffer)
+    except FrameError:
+        dropped_sessions.add(session)
+        return
+    for index, (kind, payload) in enumerate(frames):
+        if session.connection is None or session.closing or session in dropped_sessions:
+            break
+        process_frame(session, kind, payload)
+
+        # The command took the player to a room another worker owns.  Whatever they
+        # sent after it goes along with them, in order.
+        if session.handoff is not None:
+            rest = b''.join(frame_message(payload, kind) for kind, payload in frames[index + 1:])
+            session.receive_buffer[:0] = rest
+            transfer_session(session)
+            break
 
-    # Otherwise, the command is bad
 
+# Process the command in one frame, which is in binary if the player has asked for that.
+
+def process_frame(session, kind, payload):
+    if kind == KIND_HEARTBEAT:
+        # Heartbeats on a link we opened are the other process checking we're still there.
+        if session.link is not None:
+            queue_frame(session, HEARTBEAT_FRAME)
+        return
+    # Links carry nothing but batches of messages, to the end that didn't open them.
+    # Anything else on one, or a batch from a player, ends the connection.
+    if session.link is not None or session.peer is not None or kind == KIND_LINK:
+        if kind == KIND_LINK and session.peer is not None:
+            receive_link_batch(session, payload)
+        else:
+            dropped_sessions.add(session)
+        return
+    if kind == KIND_LINK_HELLO:
+        receive_link_hello(session, payload)
+        return
+    if kind == KIND_BINARY_COMMAND and session.binary:
+        try:
+            message = decode_command(payload, session.received_names)
+        except FrameError:
+            dropped_sessions.add(session)
+            return
+        session.reply_binary = True
     else:
-        connection.send("Invalid command".encode())
+        message = payload.decode(errors='replace')
+        session.reply_binary = False
+    run_command(session, message)
+
+
+# Switch a player over to binary, numbering names afresh.
+
+def start_binary(session):
+    if not session.binary:
+        session.binary = True
+        session.sent_names = NameTable()
+        session.received_names = []
+
+
+# Process a single command, counting and timing it under the name of its handler.
+
+def run_command(session, message):
+    start = time.perf_counter()
+    session.commands += 1
+    command = parse_command(message)
+    if session.bucket is not None and not rate_exempt(session, command) and not session.bucket.take():
+        metrics.increment('room_shed_total', label='rate')
+        queue_frame(session, BUSY_REPLY)
+        return
+    deliver(session, dispatch(session, command))
+    if command.name.upper() in DIRECTIONS:
+        label = 'move'
+    else:
+        label = command.name if command.name in handlers else 'other'
+    metrics.increment('room_commands_total', label=label)
+    metrics.histogram('room_command_seconds', label).observe(time.perf_counter() - start)
+
+
+# Whether a command goes through whatever a player's rate limit says: leaving, so a
+# player turned away doesn't just hang on, and joining for the first time.  Joining again
+# to change name tells the whole room, so that's limited like anything else.
+
+def rate_exempt(session, command):
+    return command.name == 'exit' or (command.name == 'join' and session.name is None)
+
+
+# Process a single command.
+
+def process_command(session, message):
+    deliver(session, dispatch(session, parse_command(message)))
+
+
+# Find the handler for a command and run it, returning its responses.  Directions are
+# accepted in any case.
+
+def dispatch(session, command):
+    entry = handlers.get(command.name)
+    if entry is None and command.name.upper() in DIRECTIONS:
+        entry = handlers.get(command.name.lower())
+    if entry is None:
+        if session.room is None and command.name:
+            return [Reply("You need to join a room first")]
+        return [Reply("Invalid command")]
+    function, needs_room, chatter = entry
+    if needs_room and session.room is None:
+        return [Reply("You need to join a room first")]
+    if chatter and fanout_bucket is not None and not fanout_bucket.has(len(session.room.occupants) - 1):
+        metrics.increment('room_shed_total', label='fanout')
+        return [Reply(SERVER_BUSY)]
+    return function(session, command)
+
+
+# Send a player everything a handler answered with.
+
+def deliver(session, responses):
+    for response in responses:
+        response_writers[type(response)](session, response)
+
+
+def write_reply(session, response):
+    send_reply(session, response.text)
+
+
+def write_summary(session, response):
+    send_summary(session, response.room)
+
+
+def write_look(session, response):
+    queue_frame(session, *look_reply(session))
+
+
+def write_items(session, response):
+    send_items(session, response.results)
+
+
+def write_exit(session, response):
+    send_exit(session, response.direction, response.destination)
+
+
+def write_event(session, response):
+    send_event(response.room, session, response.text, response.binary)
+
+
+def write_tell(session, response):
+    if response.session.binary:
+        queue_frame(response.session, frame_message(encode_text(EVENT_TEXT, response.text), KIND_BINARY_EVENT))
+    else:
+        queue_frame(response.session, frame_message(response.text, KIND_EVENT))
+
+
+def write_channel_event(session, response):
+    show_message(response.room, session, response.channel, response.text)
+
+
+def write_relay(session, response):
+    send_over_link(response.destination, response.message)
+
+
+response_writers = {Reply: write_reply, Summary: write_summary, Look: write_look, Items: write_items,
+                    ExitReply: write_exit, Event: write_event, Tell: write_tell,
+                    ChannelEvent: write_channel_event, Relay: write_relay}
+
+
+# If player is joining the server, add them to the list of players.  Joining again
+# under a different name renames the player.  A world host can be asked for a
+# particular room, otherwise players start in the start room.  Ending the join with
+# +binary switches the player over to binary messages.
+
+@register('join', needs_room=False)
+def join_command(session, command):
+    words = command.args
+    binary = bool(words) and words[-1] == '+binary'
+    if binary:
+        words = words[:-1]
+    if len(words) != 1 and len(words) != 2:
+        return [Reply("Invalid command")]
+    player = words[0]
+    room = session.room
+    existing = session_search(player)
+    if len(words) == 2 and not room_exists(words[1]):
+        return [Reply('There is no room called {} here.'.format(words[1]))]
+    elif existing is session:
+        if binary:
+            start_binary(session)
+        return [Summary(room)]
+    elif existing is not None:
+        return [Reply('The name {} is already taken.'.format(player))]
+    elif player.startswith(GIFT_MARK):
+        return [Reply('Names may not start with {}.'.format(GIFT_MARK))]
+    elif session.name is not None:
+        old_name = session_rename(session, player)
+        note_renamed(old_name, player)
+        if binary:
+            start_binary(session)
+        print(f'User {old_name} is now known as {player}')
+        return [Event(room, 'User {} is now known as {}.'.format(old_name, player)),
+                Reply('You are now known as {}.'.format(player))]
+    if len(words) == 2:
+        name = words[1]
+    else:
+        name = places.get(player)
+        if name is None or not room_exists(name):
+            name = start_room.name
+    if not owns_room(name):
+        session.handoff = (room_shard(name), ['join', 'join ' + command.text])
+        return []
+    room = find_room(name)
+    session_join(session, player, room)
+    note_place(session)
+    if binary:
+        start_binary(session)
+    print(f'User {player} joined {room.name} from address {session.address}')
+    return [Event(room, 'User {} entered the room.'.format(player), (EVENT_ENTERED, player)),
+            join_response(session)]
+
+
+# A look at a room without joining it, so clients can show it the moment they walk in.
+# Rooms owned by another worker are shown as this worker last knew them.
+
+@register('peek', needs_room=False)
+def peek_command(session, command):
+    if len(command.args) > 1 or (command.args and not room_exists(command.args[0])):
+        return [Reply('There is no room called {} here.'.format(' '.join(command.args)))]
+    if not command.args:
+        return [Summary(start_room)]
+    # A room nobody is using is made just for the reply, and neither kept nor journaled,
+    # so looking never changes anything.
+    room = rooms.get(command.args[0])
+    if room is None:
+        room = make_room(command.args[0])
+    return [Summary(room)]
+
+
+# If player is leaving the server. remove them from the list of players.
+
+@register('exit')
+def exit_command(session, command):
+    if command.args:
+        return [Reply("Invalid command")]
+    room = session.room
+    player = session.name
+    note_left(player)
+    session_leave(session)
+    session.closing = True
+    return [Event(room, 'User {} has left the server'.format(player), (EVENT_LEFT, player, None)),
+            Reply('Goodbye')]
+
+
+# If player looks around, give them the room summary.  "look since N" only tells them
+# what's changed since version N of the room, and "look since" gives them the whole room
+# along with its version.
+
+@register('look')
+def look_command(session, command):
+    if not command.args:
+        return [Look()]
+    if command.args[0] != 'since' or len(command.args) > 2:
+        return [Reply("Invalid command")]
+    version = None
+    if len(command.args) == 2:
+        if not command.args[1].isdigit():
+            return [Reply("Invalid command")]
+        version = int(command.args[1])
+    return [Reply(changes_reply(session, version))]
+
+
+# Have changes to the room pushed as events, "Version V since P" followed by a line for
+# each change, wherever the player goes.  The reply is the whole room and its version.
+
+@register('subscribe')
+def subscribe_command(session, command):
+    if command.args:
+        return [Reply("Invalid command")]
+    session.subscribed = True
+    subscribe(session, session.room)
+    return [Reply(changes_reply(session, None))]
+
+
+@register('unsubscribe')
+def unsubscribe_command(session, command):
+    if command.args:
+        return [Reply("Invalid command")]
+    session.subscribed = False
+    session.room.subscribers.discard(session)
+    return [Reply('You will no longer be sent changes to the room.')]
+
+
+# If player takes an item, make sure it is here and give it to the player.
+# Any number of items can be taken at once, as in "take 3 torch rope" or "take all".
+
+@register('take')
+def take_command(session, command):
+    if command.args == ['all']:
+        requests = [(count, item) for item, count in session.room.items.items()]
+    else:
+        requests = parse_item_counts(command.args)
+    if requests is None:
+        return [Reply("Invalid command")]
+    elif not requests:
+        return [Reply("There is nothing here to take.")]
+    return [Items(take_items(session, requests))]
+
+
+# If player drops an item, put it in the list of things here.
+
+@register('drop')
+def drop_command(session, command):
+    requests = parse_item_counts(command.args)
+    if requests is None or any(count is None for count, item in requests):
+        return [Reply("Invalid command")]
+    room = session.room
+    for count, item in requests:
+        add_items(room.items, item, count)
+        note_dropped(session, item, count)
+    room_changed(room, *['+ ' + describe_items(count, item) for count, item in requests])
+    return [Items([(ITEM_DROPPED, count, item) for count, item in requests])]
+
+
+# Hand items to another player in the room, as in "give alice 2 rope".  With --state the
+# room keeps track of what each player holds, and nobody can give what they don't have.
+# Without it the room doesn't know, so it's up to the giver to only give what they hold.
+
+@register('give')
+def give_command(session, command):
+    requests = parse_item_counts(command.args[1:])
+    if requests is None or len(requests) != 1 or requests[0][0] is None:
+        return [Reply("Invalid command")]
+    receiver = session.room.occupants.get(command.args[0])
+    if receiver is None or receiver is session:
+        return [Reply('There is nobody called {} here.'.format(command.args[0]))]
+    count, item = requests[0]
+    if journal is not None and holdings.get(session.name, {}).get(item, 0) < count:
+        return [Reply('You are not holding {}'.format(describe_items(count, item)))]
+    note_given(session, receiver, item, count)
+    items = describe_items(count, item)
+    return [Reply('{} given to {}'.format(items, receiver.name)),
+            Tell(receiver, '{} {} gave you {}.'.format(GIFT_MARK, session.name, items))]
+
+
+# If player says something to rest of server, send to other players
+
+@register('say', chatter=True)
+def say_command(session, command):
+    msg = '{} said \"{}\"'.format(session.name, command.text)
+    return [Event(session.room, msg, (EVENT_SAID, session.name, command.text)),
+            Reply('You said \"{}\".'.format(command.text))]
+
+
+# If player calls to move to one of adjacent rooms, confirm room connection and move player.
+# Rooms in this process are a move of the session; for rooms elsewhere the player is
+# told where to connect.
+
+@register(*[direction.lower() for direction in DIRECTIONS])
+def move_command(session, command):
+    direction = command.name.lower()
+    destination = server_get_room(session.room, direction)
+    if destination is None:
+        return [Reply(no_exit_message(command.name))]
+    elif isinstance(destination, str) and not owns_room(destination):
+        session.handoff = (room_shard(destination), ['move', destination])
+        return leave_room(session, direction)
+    elif isinstance(destination, str):
+        return move_player(session, direction, find_room(destination))
+    return [ExitReply(direction, destination)]
+
+
+# List the ways out of the room a line at a time, for clients: the direction, then
+# either the room it leads to here or the host, port and room it leads to elsewhere.
+
+@register('exits')
+def exits_command(session, command):
+    return [Reply('\n'.join(describe_exit(direction, destination)
+                            for direction, destination in session.room.exits.items()))]
+
+
+# Report how the server is doing.
+
+@register('stats')
+def stats_command(session, command):
+    return [Reply(stats_summary())]
+
+
+# Describe where an exit leads, as in "north Kitchen" or "north host 9000 Garden".
+
+def describe_exit(direction, destination):
+    if isinstance(destination, str):
+        return '{} {}'.format(direction, destination)
+    hostname, port, room_name = destination
+    response = '{} {} {}'.format(direction, hostname, port)
+    if room_name is not None:
+        response += ' ' + room_name
+    return response
+
+
+# Take items out of a room for a player, returning (what happened, count, item) for each.
+
+def take_items(session, requests):
+    room = session.room
+    results = []
+    changes = []
+    for count, item in requests:
+        if count is None:
+            count = room.items.get(item, 1)
+        if remove_items(room.items, item, count):
+            note_taken(session, item, count)
+            results.append((ITEM_TAKEN, count, item))
+            changes.append('- ' + describe_items(count, item))
+        else:
+            results.append((ITEM_REFUSED, count, item))
+    if changes:
+        room_changed(room, *changes)
+    return results
+
+
+# Walk a player through an exit into another room in this process.
+
+def move_player(session, direction, room):
+    old_room = session.room
+    session_move(session, room)
+    note_place(session)
+    return [Event(old_room, 'User {} left going {}.'.format(session.name, direction),
+                  (EVENT_LEFT, session.name, direction))] + enter_room(session, room)
+
+
+# Let a room know a player has walked in, and show them around.
+
+def enter_room(session, room):
+    return [Event(room, 'User {} entered the room.'.format(session.name), (EVENT_ENTERED, session.name)),
+            Summary(room)]
+
+
+# Take a player out of their room through an exit, on the way to a room another worker owns.
+
+def leave_room(session, direction):
+    room = session.room
+    player = session.name
+    session_leave(session)
+    session.name = player
+    return [Event(room, 'User {} left going {}.'.format(player, direction), (EVENT_LEFT, player, direction))]
+
+
+# The exits of a room by name, without making it from the world file if it isn't made yet.
+
+def exits_of(name):
+    room = rooms.get(name)
+    if room is not None:
+        return room.exits
+    if world is not None and name in world.index:
+        return world.room_exits(world.index[name])
+    return {}
+
+
+# Spread a shout or channel message out from a room through up to hops exits.  Returns
+# the responses that show it to the players it reaches here and relay it to rooms in other
+# processes, or None if the message had already reached the room.  Rooms the message has
+# already reached, and everything beyond them, are left alone.
+
+def spread_message(message, name, hops):
+    message_id, _, channel, player, origin, text, _ = message
+    reached = seen_messages.reached(message_id)
+    if name in reached:
+        return None
+    reached.add(name)
+    responses = []
+    if channel is None:
+        line = '{} shouted "{}" from {}.'.format(player, text, origin)
+    else:
+        line = '[{}] {} said "{}" from {}.'.format(channel, player, text, origin)
+    frontier = [name]
+    while frontier:
+        following = []
+        for here in frontier:
+            room = rooms.get(here)
+            if room is not None and room.occupants:
+                responses.append(Event(room, line) if channel is None else ChannelEvent(room, channel, line))
+            if not hops:
+                continue
+            for destination in exits_of(here).values():
+                if destination in reached:
+                    continue
+                reached.add(destination)
+                if isinstance(destination, str):
+                    following.append(destination)
+                else:
+                    responses.append(Relay(destination, [message_id, hops - 1, channel, player, origin, text,
+                                                          destination[2]]))
+        frontier = following
+        hops -= 1
+    return responses
+
+
+# Whether a shout or channel message from a player can go out under --max-fanout, going
+# by everyone it would reach in every room it spreads to and each link it's relayed over.
+# dispatch has already turned it away if the player's own room was too much.
+
+def spread_allowed(session, responses):
+    if fanout_bucket is None:
+        return True
+    fanout = 0
+    for response in responses:
+        if isinstance(response, Relay):
+            fanout += 1
+        elif isinstance(response, ChannelEvent):
+            fanout += len(channel_listeners(response.room, session, response.channel))
+        else:
+            fanout += event_fanout(response.room, session)
+    if fanout_bucket.has(fanout):
+        return True
+    metrics.increment('room_shed_total', label='fanout')
+    return False
+
+
+# Show a shout to everyone in a room, or a channel message to those listening to the channel.
+
+def show_message(room, sender, channel, line):
+    if channel is None:
+        send_event(room, sender, line)
+        return
+    listeners = channel_listeners(room, sender, channel)
+    if fanout_bucket is not None:
+        fanout_bucket.spend(len(listeners))
+    frame = None
+    binary_frame = None
+    for session in listeners:
+        if session.binary:
+            if binary_frame is None:
+                binary_frame = frame_message(encode_text(EVENT_TEXT, line), KIND_BINARY_EVENT)
+            queue_frame(session, binary_frame)
+        else:
+            if frame is None:
+                frame = frame_message(line, KIND_EVENT)
+            queue_frame(session, frame)
+
+
+# The players in a room listening to a channel, apart from the one who sent to it.
+
+def channel_listeners(room, sender, channel):
+    return [session for session in room.occupants.values()
+            if session is not sender and session.channels is not None and channel in session.channels]
+
+
+# Queue a message for the link to the process serving a room elsewhere, to go out with
+# everything else queued for that link at the end of the tick.
+
+def send_over_link(destination, message):
+    encoded = encode_message(message)
+    if encoded is None:
+        metrics.increment('room_link_messages_total', label='dropped')
+        return
+    address = destination[:2]
+    link = links.get(address)
+    if link is None:
+        link = links[address] = Link(address)
+    link.outbox.append(encoded)
+    pending_links.add(link)
+
+
+# Write each link's queued messages to it in as few frames as they fit in, connecting
+# first if need be.  Messages for a link that failed recently are dropped.
+
+def send_link_batches():
+    now = time.monotonic()
+    while pending_links:
+        link = pending_links.pop()
+        if link.session is None and not link.connecting and now >= link.retry_at:
+            open_link(link)
+        if link.session is not None:
+            frames = batch_frames(link.outbox)
+            for frame in frames:
+                queue_frame(link.session, frame)
+            metrics.increment('room_link_messages_total', len(link.outbox), label='sent')
+            metrics.increment('room_link_frames_total', len(frames))
+            link.outbox.clear()
+        elif not link.connecting:
+            metrics.increment('room_link_messages_total', len(link.outbox), label='dropped')
+            link.outbox.clear()
+
+
+# Open a link to another room process.  On the selector engine the link can be written to
+# straight away and sends once connected; on asyncio it waits for the connection.
+
+def open_link(link):
+    global serverSel
+    link.connecting = True
+    print('Opening link to room process at {}:{}'.format(*link.address))
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is not None:
+        connecting = loop.create_task(loop.create_connection(lambda: LinkProtocol(link), *link.address))
+        connecting.add_done_callback(
+            lambda done: link_failed(link) if done.cancelled() or done.exception() is not None else None)
+        return
+    connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connection.setblocking(False)
+    try:
+        error = connection.connect_ex(link.address)
+    except OSError as failure:
+        error = failure.errno
+    if error not in (0, errno.EINPROGRESS):
+        connection.close()
+        link_failed(link)
+        return
+    session = Session(connection, link.address)
+    session.link = link
+    sessions_by_fd[session.fd] = session
+    serverSel.register(connection, selectors.EVENT_READ | selectors.EVENT_WRITE, handle_connection)
+    link.session = session
+    link.connecting = False
+    queue_frame(session, hello_frame(room_port))
+
+
+# Forget a link's connection once it fails or closes, and hold off trying it again.
+
+def link_failed(link):
+    print('Link to room process at {}:{} is down'.format(*link.address))
+    link.session = None
+    link.connecting = False
+    link.retry_at = time.monotonic() + LINK_RETRY
+    if link.outbox:
+        metrics.increment('room_link_messages_total', len(link.outbox), label='dropped')
+        link.outbox.clear()
+
+
+# Spread the messages in a batch that came in over a link from the rooms they're arriving
+# in.  They go no further than our own ranges allow, however far they were sent.
+
+def receive_link_batch(session, payload):
+    try:
+        messages = decode_batch(payload)
+    except FrameError:
+        dropped_sessions.add(session)
+        return
+    if not session.bucket.take(len(messages)):
+        metrics.increment('room_link_messages_total', len(messages), label='shed')
+        return
+    for message in messages:
+        name = message[6]
+        if name is None or not room_exists(name):
+            name = start_room.name
+        hops = min(message[1], shout_range if message[2] is None else channel_range)
+        responses = spread_message(message, name, hops) if hops >= 0 else None
+        if responses is not None:
+            deliver(None, responses)
+            metrics.increment('room_link_messages_total', label='received')
+        else:
+            metrics.increment('room_link_messages_total', label='duplicate')
+
+
+# Take a connection as a link from another room process, if it hasn't joined as a player
+# and comes from a process we're allowed links from.
+
+def receive_link_hello(session, payload):
+    try:
+        peer = (session.address[0], decode_hello(payload))
+    except FrameError:
+        dropped_sessions.add(session)
+        return
+    if session.name is not None or peer not in link_peers:
+        print('Refusing link from room process at {}:{}'.format(*peer))
+        dropped_sessions.add(session)
+        return
+    print('Link from room process at {}:{}'.format(*peer))
+    start_peer(session, peer)
+
+
+def start_peer(session, peer):
+    session.peer = peer
+    session.bucket = TokenBucket(link_rate, link_rate)
+
+
+# Work out the (address, port) of every room process allowed to open a link to us: those
+# our exits lead to, and any others given.  A host that can't be looked up is left out.
+
+def find_link_peers(others):
+    remotes = set(others)
+    if world is not None:
+        remotes |= world.remotes
+    for room in rooms.values():
+        remotes.update(destination[:2] for destination in room.exits.values() if isinstance(destination, tuple))
+    peers = set()
+    for host, port in remotes:
+        try:
+            found = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except OSError as error:
+            print('Links from room process at {}:{} will be refused: {}'.format(host, port, error))
+            continue
+        peers.update((info[4][0], port) for info in found)
+    return peers
+
+
+# Shout to everyone within a few rooms, wherever those rooms are served.
+
+@register('shout', chatter=True)
+def shout_command(session, command):
+    room = session.room
+    responses = spread_message([new_message_id(), shout_range, None, session.name, room.name, command.text,
+                                room.name], room.name, shout_range)
+    if not spread_allowed(session, responses):
+        return [Reply(SERVER_BUSY)]
+    return responses + [Reply('You shouted \"{}\".'.format(command.text))]
+
+
+# Listen to a channel, or list the channels being listened to.
+
+@register('listen')
+def listen_command(session, command):
+    if len(command.args) > 1:
+        return [Reply("Invalid command")]
+    if not command.args:
+        if not session.channels:
+            return [Reply('You are not listening to any channels.')]
+        return [Reply('You are listening to {}.'.format(', '.join(sorted(session.channels))))]
+    if session.channels is None:
+        session.channels = set()
+    session.channels.add(command.args[0])
+    return [Reply('You are listening to {}.'.format(command.args[0]))]
+
+
+@register('ignore')
+def ignore_command(session, command):
+    if len(command.args) != 1:
+        return [Reply("Invalid command")]
+    if not session.channels or command.args[0] not in session.channels:
+        return [Reply('You are not listening to {}.'.format(command.args[0]))]
+    session.channels.discard(command.args[0])
+    return [Reply('You are no longer listening to {}.'.format(command.args[0]))]
+
+
+# Say something on a channel, heard by everyone listening to it within channel range.
+
+@register('chat', chatter=True)
+def chat_command(session, command):
+    if len(command.args) < 2:
+        return [Reply("Invalid command")]
+    channel = command.args[0]
+    text = command.text.split(None, 1)[1]
+    room = session.room
+    responses = spread_message([new_message_id(), channel_range, channel, session.name, room.name, text,
+                                room.name], room.name, channel_range)
+    if not spread_allowed(session, responses):
+        return [Reply(SERVER_BUSY)]
+    return responses + [Reply('You said \"{}\" on {}.'.format(text, channel))]
+
+
+# Work out which worker owns a room, by name, so workers never make rooms they don't own.
+
+def room_shard(name):
+    return zlib.crc32(name.encode()) % shard_count
+
+
+def owns_room(name):
+    return shard_count == 1 or room_shard(name) == shard_index
+
+
+# Hand a session's socket and state over to the worker that owns the room it's going to.
+
+def transfer_session(session):
+    global serverSel
+    shard, action = session.handoff
+    flush_session(session)
+    if session.connection is None or session in dropped_sessions:
+        return
+    state = session_state(session)
+    state['action'] = action
+    message = json.dumps(state).encode()
+    serverSel.unregister(session.connection)
+    del sessions_by_fd[session.fd]
+    try:
+        if len(message) > MAX_HANDOFF:
+            raise OSError('handoff of {} bytes is too large'.format(len(message)))
+        send_fds(shard_links[shard], message, [session.fd])
+    except OSError as error:
+        print('Could not hand {} over to worker {}: {}'.format(session.address, shard, error))
+    session.connection.close()
+    session.connection = None
+    session.name = None
+
+
+# Everything about a session another process needs to carry on serving it on the same
+# socket, as plain values: who and where the player is, what's still to be read and
+# sent, and the names binary messages have numbered.
+
+def session_state(session):
+    return {
+        'address': list(session.address),
+        'name': session.name,
+        'room': session.room.name if session.room is not None else None,
+        'commands': session.commands,
+        'bytes_in': session.bytes_in,
+        'bytes_out': session.bytes_out,
+        'receive': base64.b64encode(session.receive_buffer).decode(),
+        'send': base64.b64encode(b''.join(session.send_buffer)).decode(),
+        'closing': session.closing,
+        'subscribed': session.subscribed,
+        'channels': sorted(session.channels) if session.channels else [],
+        'binary': session.binary,
+        'reply_binary': session.reply_binary,
+        'sent_names': session.sent_names.names() if session.binary else [],
+        'received_names': session.received_names if session.binary else [],
+        'peer': list(session.peer) if session.peer is not None else None,
+    }
+
+
+# Start serving a session handed to us with its socket.  The player isn't put in a room.
+
+def restore_session(connection, state):
+    global serverSel
+    connection.setblocking(False)
+    session = Session(connection, tuple(state['address']))
+    session.commands = state['commands']
+    session.bytes_in = state['bytes_in']
+    session.bytes_out = state['bytes_out']
+    session.receive_buffer = bytearray(base64.b64decode(state['receive']))
+    sent = base64.b64decode(state['send'])
+    if sent:
+        session.send_buffer.append(sent)
+        session.pending = len(sent)
+    session.closing = state.get('closing', False)
+    session.subscribed = state.get('subscribed', False)
+    if state.get('channels'):
+        session.channels = set(state['channels'])
+    if state['binary']:
+        session.binary = True
+        session.sent_names = NameTable(state['sent_names'])
+        session.received_names = state['received_names']
+    session.reply_binary = state['reply_binary']
+    if state.get('peer'):
+        start_peer(session, tuple(state['peer']))
+    sessions_by_fd[session.fd] = session
+    serverSel.register(connection, selectors.EVENT_READ, handle_connection)
+    update_interest(session)
+    watch_session(session)
+    return session
+
+
+# Selector callback for our handoff socket, taking over sessions from other workers.
+
+def receive_handoff(inbox, mask):
+    global serverSel
+    try:
+        message, fds = recv_fds(inbox, MAX_HANDOFF, 1)
+    except BlockingIOError:
+        return
+    if not fds:
+        return
+    state = json.loads(message)
+    session = restore_session(socket.socket(fileno=fds[0]), state)
+
+    action = state['action']
+    if action[0] == 'join':
+        process_command(session, action[1])
+    elif action[0] == 'move':
+        room = find_room(action[1])
+        if session_search(state['name']) is not None:
+            send_reply(session, 'The name {} is already taken.'.format(state['name']))
+        else:
+            session_join(session, state['name'], room)
+            deliver(session, enter_room(session, room))
+    if session.handoff is not None:
+        transfer_session(session)
+    else:
+        process_frames(session)
+    drop_sessions()
+
+
+# Fork the worker processes.  Returns in each worker; the supervisor waits for the workers
+# to finish and never returns.
+
+def start_workers(count):
+    global serverSel
+    global shard_index
+    global shard_count
+    global shard_links
+    global shard_inbox
+
+    inboxes = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for index in range(count)]
+    workers = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            shard_index = index
+            shard_count = count
+            shard_links = [sending for receiving, sending in inboxes]
+            shard_inbox = inboxes[index][0]
+            for other, (receiving, sending) in enumerate(inboxes):
+                if other != index:
+                    receiving.close()
+            # The selector's underlying epoll/kqueue is shared across fork, so each worker needs its own.
+            serverSel = selectors.DefaultSelector()
+            shard_inbox.setblocking(False)
+            serverSel.register(shard_inbox, selectors.EVENT_READ, receive_handoff)
+            return
+        workers.append(pid)
+
+    for receiving, sending in inboxes:
+        receiving.close()
+        sending.close()
+    print('Supervisor started {} workers.'.format(count))
+
+    def stop_workers(sig, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+    while workers:
+        pid, status = os.wait()
+        if pid in workers:
+            workers.remove(pid)
+            print('Worker {} exited with status {}.'.format(pid, status))
+    sys.exit(0)
+
+
+# Hot upgrades.  On SIGUSR2 the room starts a new copy of itself, with the same
+# arguments, and hands it the listening sockets and every player's socket over a Unix
+# socket, along with what it needs to carry on: each session's state and what every room
+# holds.  Players stay connected throughout and just see a short pause.  If the new
+# process doesn't say it's taken over within UPGRADE_TIMEOUT seconds the old one carries
+# on as before.  Only the selectors engine with a single worker can be upgraded.
+
+upgrade_requested = False
+UPGRADE_TIMEOUT = 10.0
+
+# Both ends of a socket pair the signal handler writes to, so a signal wakes the loop.
+
+wakeup_sockets = None
+
+
+def upgrade_handler(sig, frame):
+    global upgrade_requested
+    upgrade_requested = True
+
+
+# Selector callback for the wakeup socket.  The loop itself looks at what was asked for.
+
+def read_wakeup(sock, mask):
+    try:
+        sock.recv(64)
+    except BlockingIOError:
+        pass
+
+
+# Hand everything over to a new process.  Returns False if the upgrade didn't happen
+# and this process should carry on serving.
+
+def hot_upgrade():
+    global journal
+    global serverSel
+    print('Upgrade requested, starting a new room process ...')
+    flush_all()
+    drop_sessions()
+    for connection in list(stats_requests):
+        serverSel.unregister(connection)
+        connection.close()
+    stats_requests.clear()
+    listeners = {'players' if key.data is accept else 'stats': key.fileobj
+                 for key in serverSel.get_map().values() if key.data in (accept, accept_stats)}
+
+    # The journal has to be written out before the new process reads it back.
+    close_journal()
+    journal = None
+
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    arguments = sys.argv[1:]
+    if '--upgrade-fd' in arguments:
+        index = arguments.index('--upgrade-fd')
+        del arguments[index:index + 2]
+    arguments += ['--upgrade-fd', str(theirs.fileno())]
+    # Links to other processes are left to close with us; the new one opens its own.
+    sessions = [session for session in sessions_by_fd.values() if session.link is None]
+    state = {
+        'listeners': list(listeners),
+        'rooms': {room.name: {'items': dict(room.items), 'version': room.version} for room in rooms.values()},
+        'sessions': [session_state(session) for session in sessions],
+    }
+    fds = [listener.fileno() for listener in listeners.values()] + [session.fd for session in sessions]
+    process = None
+    taken_over = False
+    try:
+        process = subprocess.Popen([sys.executable, sys.argv[0]] + arguments, pass_fds=[theirs.fileno()])
+        # Only the new process should hold the other end, so we hear if it dies.
+        theirs.close()
+        ours.settimeout(UPGRADE_TIMEOUT)
+        send_bundle(ours, zlib.compress(json.dumps(state, separators=(',', ':')).encode()), fds)
+        taken_over = ours.recv(16) == b'ready'
+    except OSError as error:
+        print('Could not hand over to the new process: {}'.format(error))
+    theirs.close()
+    ours.close()
+
+    if not taken_over:
+        print('Upgrade failed, carrying on as before.')
+        if process is not None and process.poll() is None:
+            process.kill()
+        if state_directory is not None:
+            journal = Journal(state_directory, sync_interval)
+        return False
+    print('Handed {} sessions over to process {}.'.format(len(sessions), process.pid))
+    return True
+
+
+# Take over from the process that started us for an upgrade.  Returns the listening
+# socket for players and the one for stats, if there was one.
+
+def take_over(fd):
+    link = socket.socket(fileno=fd)
+    message, fds = recv_bundle(link)
+    state = json.loads(zlib.decompress(message))
+    sockets = [socket.socket(fileno=received) for received in fds]
+    listeners = dict(zip(state['listeners'], sockets))
+    for name, saved in state['rooms'].items():
+        room = find_room(name)
+        if room is not None:
+            room.items = make_store()
+            for item, count in saved['items'].items():
+                add_items(room.items, item, count)
+            room_changed(room)
+    for saved, connection in zip(state['sessions'], sockets[len(listeners):]):
+        session = restore_session(connection, saved)
+        if saved['name'] is not None and session.connection is not None:
+            session_join(session, saved['name'], find_room(saved['room']) or start_room)
+    # Players coming back in are nothing new, so each room carries on from its old
+    # version.  Its change log doesn't come across, so anyone asking for changes since
+    # an earlier version gets the whole room.
+    for name, saved in state['rooms'].items():
+        room = rooms.get(name)
+        if room is not None:
+            room.version = room.pushed = saved['version']
+            room.changes = None
+    changed_rooms.clear()
+    link.send(b'ready')
+    link.close()
+    print('Took over {} sessions from the previous process.'.format(len(state['sessions'])))
+    return listeners.get('players'), listeners.get('stats')
+
+
+# Gauges read whenever the metrics are rendered.
+
+def queued_bytes():
+    return sum(session.pending for session in sessions_by_fd.values())
+
+
+def largest_queue():
+    return max((session.pending for session in sessions_by_fd.values()), default=0)
+
+
+def paused_sessions():
+    return sum(1 for session in sessions_by_fd.values() if session.paused)
+
+
+metrics.register_gauge('room_sessions', 'Connected sockets.', lambda: len(sessions_by_fd))
+metrics.register_gauge('room_players', 'Players who have joined a room.', lambda: len(sessions_by_name))
+metrics.register_gauge('room_send_queue_bytes', 'Bytes queued for players across all sessions.', queued_bytes)
+metrics.register_gauge('room_send_queue_max_bytes', 'Bytes queued for the player furthest behind.', largest_queue)
+metrics.register_gauge('room_paused_sessions', 'Players whose commands aren\'t being read until their '
+                       'queue drains.', paused_sessions)
+metrics.register_gauge('room_active_rooms', 'Rooms made into full rooms and held in memory.', lambda: len(rooms))
+
+
+# Summarize the metrics for the stats command.
+
+def stats_summary():
+    lines = ['Sessions: {}  Players: {}  Paused: {}'.format(len(sessions_by_fd), len(sessions_by_name),
+                                                           paused_sessions()),
+             'Bytes received: {}  Bytes sent: {}  Queued: {} (largest {})'.format(
+                 metrics.counters.get(('room_bytes_received_total', None), 0),
+                 metrics.counters.get(('room_bytes_sent_total', None), 0), queued_bytes(), largest_queue())]
+    shed = [(reason, metrics.counters.get(('room_shed_total', reason), 0))
+            for reason in ('sessions', 'rate', 'fanout')]
+    if any(count for reason, count in shed):
+        lines.append('Turned away: ' + '  '.join('{} {}'.format(reason, count) for reason, count in shed))
+    if world is not None:
+        lines.append('Rooms: {} in memory of {} in the world'.format(len(rooms), len(world)))
+    if links:
+        lines.append('Links: {} open of {}  Messages sent: {}  received: {}  duplicates: {}'.format(
+            sum(1 for link in links.values() if link.session is not None), len(links),
+            *(metrics.counters.get(('room_link_messages_total', result), 0)
+              for result in ('sent', 'received', 'duplicate'))))
+    loop = metrics.histograms.get(('room_loop_seconds', None))
+    if loop is not None:
+        lines.append('Loop pass: {} passes, p50 {} ms, p99 {} ms'.format(
+            loop.count, loop.percentile(0.5) * 1000, loop.percentile(0.99) * 1000))
+    lines.append('{:<8}{:>10}{:>10}{:>10}'.format('command', 'count', 'p50 ms', 'p99 ms'))
+    for (name, command), found in sorted(metrics.histograms.items(), key=lambda entry: str(entry[0])):
+        if name == 'room_command_seconds':
+            lines.append('{:<8}{:>10}{:>10}{:>10}'.format(command, found.count, found.percentile(0.5) * 1000,
+                                                          found.percentile(0.99) * 1000))
+    return '\n'.join(lines)
+
+
+# The HTTP response to a scrape of the stats port.
+
+def stats_response():
+    body = metrics.render_prometheus().encode()
+    return (b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+            b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+
+
+# Selector callback for the stats port, taking a connection from a scraper.
+
+def accept_stats(listener, mask):
+    global serverSel
+    connection, address = listener.accept()
+    connection.setblocking(False)
+    stats_requests[connection] = bytearray()
+    serverSel.register(connection, selectors.EVENT_READ, answer_stats)
+
+
+# Read a scraper's request and answer it with the metrics once the request is complete.
+
+def answer_stats(connection, mask):
+    global serverSel
+    try:
+        data = connection.recv(4096)
+    except BlockingIOError:
+        return
+    except OSError:
+        data = b''
+    request = stats_requests[connection]
+    request += data
+    if data and b'\r\n\r\n' not in request and len(request) < 8192:
+        return
+    serverSel.unregister(connection)
+    del stats_requests[connection]
+    if data:
+        try:
+            # The response is small, so a short blocking send won't hold up the loop.
+            connection.settimeout(0.5)
+            connection.sendall(stats_response())
+        except OSError:
+            pass
+    connection.close()
+
+
+# The stats port under the asyncio engine.
+
+class StatsProtocol(asyncio.Protocol):
+
+    def __init__(self):
+        self.transport = None
+        self.request = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.request += data
+        if b'\r\n\r\n' in self.request or len(self.request) >= 8192:
+            self.transport.write(stats_response())
+            self.transport.close()
+
+
+# asyncio engine.  This serves exactly the same commands as the selector loop above,
+# but leaves buffering and flow control to asyncio's transports and can drain the
+# room gracefully on shutdown.
+
+# How long to wait for queued replies to reach players when shutting down, in seconds.
+DRAIN_TIMEOUT = 5.0
+
+# Work done once a pass of the event loop rather than for every read, as the selector
+# loop does it: the handle of the callback due to do it, and when the pass started.
+tick_handle = None
+tick_started = 0.0
+
+
+# Have the end of this pass of the event loop, or of the next tick with --tick, seen to.
+# Everything that queues frames on this engine starts with a read, the timer wheel or a
+# link connecting, and each of those asks for it.
+
+def schedule_tick():
+    global tick_handle
+    global tick_started
+    loop = asyncio.get_running_loop()
+    if tick_length:
+        tick_handle = loop.call_later(tick_length, end_tick)
+    else:
+        tick_handle = loop.call_soon(end_tick)
+    tick_started = time.perf_counter()
+
+
+# Drop whoever needs dropping, push room changes and link batches, write out everything
+# queued for each player in one go and journal what changed.
+
+def end_tick():
+    global tick_handle
+    tick_handle = None
+    drop_sessions()
+    push_all_changes()
+    send_link_batches()
+    flush_all()
+    save_changes()
+    metrics.histogram('room_loop_seconds').observe(time.perf_counter() - tick_started)
+    if (dropped_sessions or flush_sessions) and tick_handle is None:
+        schedule_tick()
+
+
+class RoomProtocol(asyncio.Protocol):
+
+    def __init__(self):
+        self.session = None
+        self.transport = None
+
+    # A connection over the session limit gets the busy reply and is closed once the
+    # player has had their say, or after a grace period, like the selector engine does.
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if max_sessions and len(sessions_by_fd) >= max_sessions:
+            metrics.increment('room_shed_total', label='sessions')
+            transport.write(BUSY_REPLY)
+            transport.write_eof()
+            if len(rejected_connections) >= MAX_REJECTED:
+                oldest = next(iter(rejected_connections))
+                del rejected_connections[oldest]
+                oldest.abort()
+            rejected_connections[transport] = None
+            asyncio.get_running_loop().call_later(REJECT_GRACE, self.close_rejected)
+            return
+        address = transport.get_extra_info('peername')
+        print("New socket registered from address {}".format(address))
+        metrics.increment('room_connections_total')
+        transport.set_write_buffer_limits(high=high_watermark, low=low_watermark)
+        self.session = Session(transport.get_extra_info('socket'), address, transport)
+        sessions_by_fd[self.session.fd] = self.session
+        watch_session(self.session)
+
+    def close_rejected(self):
+        rejected_connections.pop(self.transport, None)
+        self.transport.close()
+
+    def data_received(self, data):
+        session = self.session
+        if session is None:
+            self.close_rejected()
+            return
+        if session.connection is None:
+            return
+        if tick_handle is None:
+            schedule_tick()
+        session.bytes_in += len(data)
+        session.last_seen = time.monotonic()
+        metrics.increment('room_bytes_received_total', len(data))
+        session.receive_buffer += data
+        try:
+            frames = unframe_messages(session.receive_buffer)
+        except FrameError:
+            dropped_sessions.add(session)
+            frames = []
+        for kind, payload in frames:
+            if session.connection is None or session.closing or session in dropped_sessions:
+                break
+            process_frame(session, kind, payload)
+
+    def eof_received(self):
+        if self.session is None:
+            return
+        dropped_sessions.add(self.session)
+        if tick_handle is None:
+            schedule_tick()
+
+    def connection_lost(self, exc):
+        session = self.session
+        if session is None:
+            rejected_connections.pop(self.transport, None)
+            return
+        if session.connection is None:
+            return
+        if session.closing:
+            close_session(session)
+        else:
+            dropped_sessions.add(session)
+            if tick_handle is None:
+                schedule_tick()
+
+    # Too much is queued for this player, so stop reading their commands until it drains.
+
+    def pause_writing(self):
+        self.session.paused = True
+        self.session.transport.pause_reading()
+
+    def resume_writing(self):
+        self.session.paused = False
+        if not self.session.closing:
+            self.session.transport.resume_reading()
+
+
+# The asyncio end of a link we opened to another room process.  It's a session like any
+# other once connected, apart from not being watched for heartbeats: the other process
+# sends those, and we answer them.
+
+class LinkProtocol(RoomProtocol):
+
+    def __init__(self, link):
+        super().__init__()
+        self.link = link
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.session = Session(transport.get_extra_info('socket'), self.link.address, transport)
+        self.session.link = self.link
+        sessions_by_fd[self.session.fd] = self.session
+        self.link.session = self.session
+        self.link.connecting = False
+        queue_frame(self.session, hello_frame(room_port))
+        pending_links.add(self.link)
+        if tick_handle is None:
+            schedule_tick()
+
+
+# Stop taking new players, tell everyone in the room we're closing and give their
+# sockets a chance to flush before the engine returns.
+
+async def drain_room(server):
+    server.close()
+    frame = frame_message('The room is shutting down.', KIND_EVENT)
+    for session in list(sessions_by_fd.values()):
+        if session.link is None and session.peer is None:
+            queue_frame(session, frame)
+        session.closing = True
+    flush_all()
+    for session in list(sessions_by_fd.values()):
+        session.transport.close()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + DRAIN_TIMEOUT
+    while sessions_by_fd and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    for session in list(sessions_by_fd.values()):
+        close_session(session)
+    await server.wait_closed()
+
+
+# Run the room on the asyncio engine until interrupted.
+
+async def serve_asyncio(port, backlog, stats_port):
+    global room_port
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(RoomProtocol, '', port, backlog=backlog)
+    room_port = server.sockets[0].getsockname()[1]
+    print('\nRoom will wait for players at port: ' + str(room_port))
+    stats_server = None
+    if stats_port is not None:
+        stats_server = await loop.create_server(StatsProtocol, '127.0.0.1', stats_port)
+        print('Stats are served at port: ' + str(stats_server.sockets[0].getsockname()[1]))
+
+    # Turn the timer wheel once a tick for heartbeats and idle players.
+    def turn_wheel():
+        timer_wheel.advance()
+        if tick_handle is None:
+            schedule_tick()
+        loop.call_later(timer_wheel.resolution, turn_wheel)
+
+    if timer_wheel is not None:
+        loop.call_later(timer_wheel.resolution, turn_wheel)
+
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stopping.set)
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    await stopping.wait()
+    print('Interrupt received, shutting down ...')
+    if stats_server is not None:
+        stats_server.close()
+    await drain_room(server)
 
 
 # Our main function.
 
 def main():
-    global name
-    global description
-    global items
-    global adjacent_rooms
+    global start_room
+    global world
+    global high_watermark
+    global low_watermark
+    global max_buffer
+    global tick_length
+    global journal
+    global snapshot_every
+    global max_sessions
+    global command_rate
+    global command_burst
+    global fanout_bucket
+    global timer_wheel
+    global heartbeat_interval
+    global idle_timeout
+    global state_directory
+    global sync_interval
+    global wakeup_sockets
+    global upgrade_requested
+    global spare_fd
+    global shout_range
+    global channel_range
+    global room_port
+    global link_peers
+    global link_rate
 
     # Register our signal handler for shutting down.
 
@@ -257,8 +2497,6 @@ def main():
 
     # Check command line arguments for room settings.
     parser = argparse.ArgumentParser()
-    # NEW CODE for parsing optional arguments
-    # subparser = parser.add_subparsers()
     # Parsing optional arguments
     parser.add_argument("-s", type=str, nargs=1)
     parser.add_argument("-n", type=str, nargs=1)
@@ -266,58 +2504,250 @@ def main():
     parser.add_argument("-w", type=str, nargs=1)
     parser.add_argument("-u", type=str, nargs=1)
     parser.add_argument("-d", type=str, nargs=1)
+    # Serving a whole world of rooms instead of a single one
+    parser.add_argument("--world", help="world file describing every room this process serves")
+    # Choosing the event loop that serves players
+    parser.add_argument("--engine", choices=['selectors', 'asyncio'], default='selectors',
+                        help="event loop to serve players with")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes to split the rooms across")
+    parser.add_argument("--tick", type=float, default=0.0,
+                        help="milliseconds to collect output for before writing it, 0 to write every loop pass")
+    parser.add_argument("--stats-port", type=int,
+                        help="local port to serve metrics on in the Prometheus text format")
+    # Keeping room state across restarts
+    parser.add_argument("--state", help="directory to keep a journal and snapshots of room state in")
+    parser.add_argument("--sync-interval", type=float, default=100.0,
+                        help="milliseconds between syncs of the journal to disk")
+    parser.add_argument("--snapshot-every", type=int, default=snapshot_every,
+                        help="journal records to write before compacting them into a snapshot")
+    parser.add_argument("--backlog", type=int, default=128,
+                        help="how many connections may wait to be accepted")
+    # Limits on how much can be queued for a slow player, in bytes
+    parser.add_argument("--high-water", type=int, default=high_watermark,
+                        help="stop reading a player's commands once this much is queued for them")
+    parser.add_argument("--low-water", type=int, default=low_watermark,
+                        help="resume reading a player's commands once their queue drains to this")
+    parser.add_argument("--max-buffer", type=int, default=max_buffer,
+                        help="drop a player once this much is queued for them")
+    # Admission control, turning work away with a busy reply rather than falling behind
+    parser.add_argument("--max-sessions", type=int, default=0,
+                        help="most connections to serve at once (per worker), 0 for no limit")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="commands a second each player may send, 0 for no limit")
+    parser.add_argument("--burst", type=int, default=command_burst,
+                        help="commands a player may send at once before --rate applies")
+    parser.add_argument("--max-fanout", type=float, default=0.0,
+                        help="events a second to send players before chatter is turned away, 0 for no limit")
+    # Noticing players who have gone without saying so
+    parser.add_argument("--heartbeat", type=float, default=0.0,
+                        help="seconds a player may be quiet before being sent a heartbeat, 0 for none")
+    parser.add_argument("--idle-timeout", type=float, default=0.0,
+                        help="seconds a player may send nothing, heartbeats included, before being dropped")
+    # How far shouts and channel messages spread, in rooms here and elsewhere
+    parser.add_argument("--shout-range", type=int, default=shout_range,
+                        help="exits a shout passes through")
+    parser.add_argument("--channel-range", type=int, default=channel_range,
+                        help="exits a channel message passes through")
+    parser.add_argument("--link-from", action='append', default=[],
+                        help="room://host:port of another room process to take links from, besides those "
+                             "our exits lead to")
+    parser.add_argument("--link-rate", type=float, default=link_rate,
+                        help="messages a second each link from another room process may bring in")
+    # Set by the process handing over to us in a hot upgrade
+    parser.add_argument("--upgrade-fd", type=int, help=argparse.SUPPRESS)
     # Parsing arguments necessary for server launch
     parser.add_argument("port", type=int, help="port number to list on")
-    parser.add_argument("name", help="name of the room")
-    parser.add_argument("description", help="description of the room")
+    parser.add_argument("name", nargs='?', help="name of the room")
+    parser.add_argument("description", nargs='?', help="description of the room")
     parser.add_argument("item", nargs='*', help="items found in the room by default")
     args = parser.parse_args()
     port = args.port
-    name = args.name
-    description = args.description
-    items = args.item
+    high_watermark = args.high_water
+    low_watermark = min(args.low_water, high_watermark)
+    max_buffer = max(args.max_buffer, high_watermark)
+    tick_length = max(args.tick, 0.0) / 1000
+    max_sessions = max(args.max_sessions, 0)
+    command_rate = max(args.rate, 0.0)
+    command_burst = max(args.burst, 1)
+    shout_range = max(args.shout_range, 0)
+    channel_range = max(args.channel_range, 0)
+    link_rate = max(args.link_rate, 1.0)
+    if args.max_fanout > 0:
+        fanout_bucket = TokenBucket(args.max_fanout, args.max_fanout)
+    heartbeat_interval = max(args.heartbeat, 0.0)
+    idle_timeout = max(args.idle_timeout, 0.0)
+    # A quiet player only shows they're still there by answering heartbeats, so an idle
+    # timeout needs them.
+    if idle_timeout and not heartbeat_interval:
+        heartbeat_interval = idle_timeout / 3
+    if heartbeat_interval:
+        timer_wheel = TimerWheel()
+
+    # Load the world, or build the single room given on the command line.
+    if args.world:
+        started = time.perf_counter()
+        try:
+            world = worlds.load_world(args.world)
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            print('Error: Could not load world {}: {}'.format(args.world, error))
+            sys.exit(1)
+        start_room = find_room(world.names[world.start])
+        print('World loaded with {} rooms in {:.1f} ms.'.format(
+            len(world), (time.perf_counter() - started) * 1000))
+    else:
+        if args.name is None or args.description is None:
+            parser.error('a room name and description are needed unless --world is given')
+        start_room = Room(args.name, args.description, args.item)
+        rooms[start_room.name] = start_room
 
     # Updating connections list
-    if args.n:
-        server_addr = urlparse(args.n[0])
-        adjacent_rooms.append(("north", str(server_addr.hostname), server_addr.port))
-    if args.s:
-        server_addr = urlparse(args.s[0])
-        adjacent_rooms.append(("south", str(server_addr.hostname), server_addr.port))
-    if args.e:
-        server_addr = urlparse(args.e[0])
-        adjacent_rooms.append(("east", str(server_addr.hostname), server_addr.port))
-    if args.w:
-        server_addr = urlparse(args.w[0])
-        adjacent_rooms.append(("west", str(server_addr.hostname), server_addr.port))
-    if args.u:
-        server_addr = urlparse(args.u[0])
-        adjacent_rooms.append(("up", str(server_addr.hostname), server_addr.port))
-    if args.d:
-        server_addr = urlparse(args.d[0])
-        adjacent_rooms.append(("down", str(server_addr.hostname), server_addr.port))
+    try:
+        for direction, flag in (('north', args.n), ('south', args.s), ('east', args.e),
+                                ('west', args.w), ('up', args.u), ('down', args.d)):
+            if flag:
+                start_room.exits[direction] = parse_exit(flag[0])
+                room_changed(start_room)
+    except ValueError as error:
+        print('Error: {}'.format(error))
+        sys.exit(1)
+
+    # Work out which room processes may link to us.
+    others = []
+    for other in args.link_from:
+        try:
+            destination = parse_exit(other)
+        except ValueError as error:
+            print('Error: {}'.format(error))
+            sys.exit(1)
+        if isinstance(destination, str):
+            print('Error: --link-from needs a room:// URL, not {}'.format(other))
+            sys.exit(1)
+        others.append(destination[:2])
+    link_peers = find_link_peers(others)
+
+    # Pick up where the last run left off, and journal changes from here on.
+    if args.state:
+        if args.workers > 1:
+            parser.error('--state needs a single worker')
+        started = time.perf_counter()
+        try:
+            state, replayed = load_state(args.state)
+        except (OSError, ValueError, KeyError) as error:
+            print('Error: Could not load saved state from {}: {}'.format(args.state, error))
+            sys.exit(1)
+        restore_state(state)
+        print('State restored from {} in {:.1f} ms, replaying {} journal records.'.format(
+            args.state, (time.perf_counter() - started) * 1000, replayed))
+        snapshot_every = max(args.snapshot_every, 1)
+        state_directory = args.state
+        sync_interval = max(args.sync_interval, 0.0) / 1000
+        journal = Journal(state_directory, sync_interval)
+        journal.snapshot(current_state())
 
     # Report initial room state.
     print('Room Starting Description:\n')
-    print_room_summary()
+    print_room_summary(start_room)
+
+    if args.workers > 1 and args.engine != 'selectors':
+        parser.error('--workers needs the selectors engine')
+
+    if args.engine == 'asyncio':
+        # uvloop is a faster drop-in event loop, used when it's installed.
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.run(serve_asyncio(port, args.backlog, args.stats_port))
+        close_journal()
+        print("Shutting down...")
+        return
 
     # Create the socket.  We will ask this to work on any interface and to use
     # the port given at the command line.  We'll print this out for clients to use.
 
-    room_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    room_socket.setblocking(False)
-    room_socket.bind(('', port))
-    room_socket.listen(5)
-    print('\nRoom will wait for players at port: ' + str(room_socket.getsockname()[1]))
-
-    # Registering the accept function to selector
+    # In a hot upgrade the sockets, players and all, come from the process we're replacing.
+    stats_socket = None
+    if args.upgrade_fd is not None:
+        try:
+            room_socket, stats_socket = take_over(args.upgrade_fd)
+        except (OSError, ValueError, KeyError) as error:
+            print('Error: Could not take over from the previous process: {}'.format(error))
+            sys.exit(1)
+    else:
+        room_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        room_socket.setblocking(False)
+        room_socket.bind(('', port))
+        room_socket.listen(args.backlog)
+    room_port = room_socket.getsockname()[1]
+    print('\nRoom will wait for players at port: ' + str(room_port))
+
+    # Split the rooms across worker processes if asked to.  Only the workers go on from here.
+    if args.workers > 1:
+        start_workers(args.workers)
+
+    # Registering the accept function to selector, with a descriptor kept back for
+    # turning connections away once we run out.
+    spare_fd = os.open(os.devnull, os.O_RDONLY)
     serverSel.register(room_socket, selectors.EVENT_READ, accept)
 
-    # Loop forever waiting for messages from clients.
-    while keep_running:
-        for key, mask in serverSel.select():
-            callback = key.data
-            callback(key.fileobj, mask)
+    # Serve metrics locally if asked to.  Each worker has its own metrics, on consecutive ports.
+    if args.stats_port is not None and stats_socket is None:
+        stats_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stats_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        stats_socket.setblocking(False)
+        stats_socket.bind(('127.0.0.1', args.stats_port + shard_index if args.stats_port else 0))
+        stats_socket.listen(16)
+    if stats_socket is not None:
+        print('Stats are served at port: ' + str(stats_socket.getsockname()[1]))
+        serverSel.register(stats_socket, selectors.EVENT_READ, accept_stats)
+
+    # Upgrade in place on SIGUSR2.  The signal wakes the loop through a socket pair.
+    if shard_count == 1:
+        wakeup_sockets = socket.socketpair()
+        for wakeup_socket in wakeup_sockets:
+            wakeup_socket.setblocking(False)
+        signal.set_wakeup_fd(wakeup_sockets[1].fileno())
+        serverSel.register(wakeup_sockets[0], selectors.EVENT_READ, read_wakeup)
+        signal.signal(signal.SIGUSR2, upgrade_handler)
+
+    # Loop forever waiting for messages from clients, flushing what they're sent once a tick.
+    loop_time = metrics.histogram('room_loop_seconds')
+    next_flush = time.monotonic()
+    try:
+        while keep_running:
+            timeout = None
+            if flush_sessions or changed_rooms or pending_links:
+                timeout = max(0.0, next_flush - time.monotonic())
+            if timer_wheel is not None and timer_wheel.count:
+                wait = timer_wheel.timeout()
+                timeout = wait if timeout is None else min(timeout, wait)
+            if rejected_connections:
+                wait = max(0.0, next(iter(rejected_connections.values())) - time.monotonic())
+                timeout = wait if timeout is None else min(timeout, wait)
+            events = serverSel.select(timeout)
+            start = time.perf_counter()
+            for key, mask in events:
+                callback = key.data
+                callback(key.fileobj, mask)
+            if upgrade_requested:
+                upgrade_requested = False
+                if hot_upgrade():
+                    break
+            if timer_wheel is not None:
+                timer_wheel.advance()
+            expire_rejected()
+            now = time.monotonic()
+            if now >= next_flush:
+                push_all_changes()
+                send_link_batches()
+                flush_all()
+                next_flush = now + tick_length
+            drop_sessions()
+            save_changes()
+            if events:
+                loop_time.observe(time.perf_counter() - start)
+    finally:
+        # Whatever stopped the loop, don't lose the changes the journal hasn't written yet.
+        close_journal()
     print("Shutting down...")
     serverSel.close()
     # while True:
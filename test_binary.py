@@ -0,0 +1,73 @@
+import unittest
+
+from protocol import FrameError
+from binary import (NameTable, encode_command, decode_command, encode_items, decode_reply, read_varint,
+                    write_varint, ITEM_TAKEN, ITEM_DROPPED, ITEM_REFUSED)
+
+
+# Binary commands and replies decoding back to the text they stand for, with names
+# numbered the same way on both sides.
+
+class RoundTripTest(unittest.TestCase):
+
+    def test_commands_with_repeated_names(self):
+        table = NameTable()
+        names = []
+        for command in ['take torch', 'drop 2 torch', 'take rope torch', 'take all', 'take all rope',
+                        'drop rope', 'look', 'north', 'say hello there', 'whisper bob hi']:
+            self.assertEqual(decode_command(encode_command(table, command), names), command)
+        self.assertEqual(names, ['torch', 'rope'])
+        self.assertEqual(table.names(), names)
+
+    # The second time a name is sent it's a single byte.
+
+    def test_repeated_name_is_numbered(self):
+        table = NameTable()
+        first = encode_command(table, 'take torch')
+        second = encode_command(table, 'take torch')
+        self.assertEqual(len(first) - len(second), len('torch'))
+
+    def test_items_with_repeated_names(self):
+        table = NameTable()
+        names = []
+        replies = [([(ITEM_TAKEN, 1, 'torch'), (ITEM_TAKEN, 3, 'rope')], 'torch taken\n3 x rope taken'),
+                   ([(ITEM_DROPPED, 2, 'torch')], '2 x torch dropped'),
+                   ([(ITEM_REFUSED, 300, 'gem'), (ITEM_DROPPED, 1, 'rope')],
+                    '300 x gem cannot be taken in this room\nrope dropped')]
+        for results, text in replies:
+            self.assertEqual(decode_reply(encode_items(table, results), names), text)
+        self.assertEqual(names, ['torch', 'rope', 'gem'])
+
+    # A name number the other side never sent means the tables are out of step.
+
+    def test_unknown_name_number(self):
+        table = NameTable()
+        encode_command(table, 'take torch')
+        with self.assertRaises(FrameError):
+            decode_command(encode_command(table, 'take torch'), [])
+
+
+class VarintTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for value in [0, 1, 127, 128, 300, 16383, 16384, 2 ** 32]:
+            out = bytearray()
+            write_varint(out, value)
+            self.assertEqual(read_varint(out, 0), (value, len(out)))
+
+    def test_truncated(self):
+        for data in [b'', b'\x80', b'\xff\xff']:
+            with self.assertRaises(FrameError):
+                read_varint(data, 0)
+        with self.assertRaises(FrameError):
+            decode_reply(bytes([1, 0x81]), [])
+
+    def test_oversized(self):
+        with self.assertRaises(FrameError):
+            read_varint(b'\xff' * 10 + b'\x01', 0)
+        with self.assertRaises(FrameError):
+            decode_command(bytes([2]) + b'\x80' * 8 + b'\x01', [])
+
+
+if __name__ == '__main__':
+    unittest.main()
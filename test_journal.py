@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from journal import Journal, load_state, JOURNAL_FILE, SNAPSHOT_FILE
+
+
+# Replaying the journal after a crash part way through a snapshot.
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_journal(self):
+        journal = Journal(self.directory, 0.01)
+        journal.snapshot({'rooms': {'Hall': {'torch': 3}}, 'holdings': {}, 'places': {}})
+        journal.record('t', 'Hall', 'torch', 1, 'alice')
+        journal.record('d', 'Hall', 'gem', 2, 'alice')
+        journal.close()
+
+    def test_journal_replayed_on_snapshot(self):
+        self.write_journal()
+        state, replayed = load_state(self.directory)
+        self.assertEqual(replayed, 2)
+        self.assertEqual(state['rooms'], {'Hall': {'torch': 2, 'gem': 2}})
+        self.assertEqual(state['holdings'], {'alice': {'torch': 1}})
+
+    # The new snapshot has been written but the old journal is still there, as when the
+    # room dies between the two.  Its records are in the snapshot and mustn't count twice.
+
+    def test_journal_older_than_snapshot_is_skipped(self):
+        self.write_journal()
+        state, replayed = load_state(self.directory)
+        with open(os.path.join(self.directory, SNAPSHOT_FILE), 'w') as snapshot_file:
+            json.dump(dict(state, generation=2), snapshot_file)
+        state, replayed = load_state(self.directory)
+        self.assertEqual(replayed, 0)
+        self.assertEqual(state['rooms'], {'Hall': {'torch': 2, 'gem': 2}})
+
+        # Journaling carries on in a fresh journal of the snapshot's generation.
+        journal = Journal(self.directory, 0.01)
+        journal.record('t', 'Hall', 'gem', 1, 'bob')
+        journal.close()
+        state, replayed = load_state(self.directory)
+        self.assertEqual(replayed, 1)
+        self.assertEqual(state['rooms'], {'Hall': {'torch': 2, 'gem': 1}})
+
+    # Journals written before generations were kept are still replayed.
+
+    def test_journal_without_generation(self):
+        with open(os.path.join(self.directory, JOURNAL_FILE), 'w') as journal_file:
+            journal_file.write('["d","Hall","gem",1,"alice"]\n')
+        state, replayed = load_state(self.directory)
+        self.assertEqual(replayed, 1)
+        self.assertEqual(state['rooms'], {'Hall': {'gem': 1}})
+
+
+if __name__ == '__main__':
+    unittest.main()
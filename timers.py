@@ -0,0 +1,64 @@
+import math
+import time
+
+# A hashed timer wheel for the room's event loop.  Time is cut into ticks of a fixed
+# length and every timer goes in the slot for the tick it's due in, modulo the number of
+# slots, so scheduling is an append and each tick only looks at the timers in one slot.
+# Timers further off than one turn of the wheel wait in their slot for later turns.
+# Timers can't be cancelled; whatever they call checks whether it's still wanted, which
+# lets busy sessions push their deadlines back without touching the wheel at all.
+
+# Length of a tick in seconds, and slots in the wheel.
+
+RESOLUTION = 0.25
+SLOTS = 1024
+
+
+class TimerWheel:
+    __slots__ = ('resolution', 'slots', 'tick', 'count')
+
+    def __init__(self, resolution=RESOLUTION, slots=SLOTS):
+        self.resolution = resolution
+        self.slots = [[] for index in range(slots)]
+        # The last tick whose timers have been run.
+        self.tick = int(time.monotonic() / resolution)
+        self.count = 0
+
+    # Call callback(*args) once delay seconds have passed, or as soon after as the loop
+    # gets round to it.  Timers never go off early.
+
+    def schedule(self, delay, callback, *args):
+        due = max(math.ceil((time.monotonic() + delay) / self.resolution), self.tick + 1)
+        self.slots[due % len(self.slots)].append((due, callback, args))
+        self.count += 1
+
+    # How long the loop may wait before the wheel next needs turning, or None if there
+    # are no timers at all.
+
+    def timeout(self):
+        if not self.count:
+            return None
+        return max(0.0, (self.tick + 1) * self.resolution - time.monotonic())
+
+    # Run every timer that has come due.  A loop that fell a long way behind visits each
+    # slot at most once.
+
+    def advance(self):
+        target = int(time.monotonic() / self.resolution)
+        if target <= self.tick:
+            return
+        size = len(self.slots)
+        fired = []
+        for tick in range(self.tick + 1, self.tick + 1 + min(target - self.tick, size)):
+            index = tick % size
+            slot = self.slots[index]
+            if not slot:
+                continue
+            waiting = [entry for entry in slot if entry[0] > target]
+            if len(waiting) != len(slot):
+                fired.extend(entry for entry in slot if entry[0] <= target)
+                self.slots[index] = waiting
+        self.tick = target
+        self.count -= len(fired)
+        for due, callback, args in fired:
+            callback(*args)
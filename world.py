@@ -0,0 +1,142 @@
+import gc
+import json
+import sys
+from urllib.parse import urlparse
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+# World files.  A whole world of rooms is described in one JSON or TOML file:
+#
+#   {"start": "Hall",
+#    "rooms": [{"name": "Hall", "description": "...", "items": ["sword"],
+#               "exits": {"north": "Kitchen", "east": "room://host:port/Garden"}}]}
+#
+# or, in TOML (Python 3.11 or later):
+#
+#   start = "Hall"
+#   [[rooms]]
+#   name = "Hall"
+#   description = "..."
+#   items = ["sword"]
+#   exits = { north = "Kitchen", east = "room://host:port/Garden" }
+#
+# The file is read once into a World: flat lists indexed by room number, with exits
+# to rooms in the same world held as numbers.  The room server only builds a full room
+# from it when a player first needs one.
+
+DIRECTIONS = ('north', 'south', 'east', 'west', 'up', 'down')
+
+
+# Work out where an exit given on the command line or in a world file leads.  Either
+# a room://host:port URL, optionally naming a room on that host, or the name of a room
+# in this process.
+
+def parse_exit(destination):
+    if destination.startswith('room://'):
+        server_addr = urlparse(destination)
+        if server_addr.hostname is None or server_addr.port is None:
+            raise ValueError('Invalid room URL {}'.format(destination))
+        room_name = server_addr.path.lstrip('/') or None
+        return (str(server_addr.hostname), server_addr.port, room_name)
+    return destination
+
+
+# Every room of a world, by number.  Exits are a flat tuple of direction, destination,
+# direction, destination ... for each room, where the destination is the number of a room
+# in this world or a (hostname, port, room name) tuple for one somewhere else.  Rooms
+# holding the same items share one tuple of them.  Remotes are the (hostname, port) of
+# every other process an exit leads to.
+
+class World:
+    __slots__ = ('names', 'index', 'descriptions', 'items', 'exits', 'start', 'remotes')
+
+    def __init__(self):
+        self.names = []
+        self.index = {}
+        self.descriptions = []
+        self.items = []
+        self.exits = []
+        self.start = 0
+        self.remotes = set()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    # The exits of a room by direction, with rooms in this world given by name.
+
+    def room_exits(self, number):
+        exits = self.exits[number]
+        return {direction: self.names[destination] if isinstance(destination, int) else destination
+                for direction, destination in zip(exits[::2], exits[1::2])}
+
+
+# Read a world file, JSON or TOML going by its extension.
+
+def read_world_file(path):
+    if path.endswith('.toml'):
+        if tomllib is None:
+            raise ValueError('TOML world files need Python 3.11 or later')
+        with open(path, 'rb') as world_file:
+            return tomllib.load(world_file)
+    with open(path) as world_file:
+        return json.load(world_file)
+
+
+# Work out the exits of one room, with rooms in this world given by number.
+
+def resolve_exits(world, name, exits):
+    resolved = []
+    for direction, destination in exits.items():
+        if direction not in DIRECTIONS:
+            if direction.lower() not in DIRECTIONS:
+                raise ValueError('Room {} has an exit in unknown direction {}'.format(name, direction))
+            direction = direction.lower()
+        number = world.index.get(destination)
+        if number is None:
+            number = parse_exit(destination)
+            if isinstance(number, str):
+                raise ValueError('Room {} leads {} to unknown room {}'.format(name, direction, destination))
+            world.remotes.add(number[:2])
+        resolved.append(direction)
+        resolved.append(number)
+    return tuple(resolved)
+
+
+# Load a world file into a World, checking every exit leads somewhere.  The garbage
+# collector is kept out of the way while the file's many small objects are made, and the
+# World is left out of later collections since it never changes.
+
+def load_world(path):
+    gc.disable()
+    try:
+        description = read_world_file(path)
+        entries = description['rooms']
+        world = World()
+        world.names = [entry['name'] for entry in entries]
+        world.index = {name: number for number, name in enumerate(world.names)}
+        if len(world.index) != len(world.names):
+            seen = set()
+            duplicate = next(name for name in world.names if name in seen or seen.add(name))
+            raise ValueError('Room {} is in the world twice'.format(duplicate))
+        if not world.names:
+            raise ValueError('The world has no rooms')
+        world.descriptions = [entry.get('description', '') for entry in entries]
+        shared = {}
+        world.items = [shared.setdefault(items, items)
+                       for items in (tuple(map(sys.intern, entry.get('items', ()))) for entry in entries)]
+        world.exits = [resolve_exits(world, entry['name'], entry['exits']) if 'exits' in entry else ()
+                       for entry in entries]
+        start = description.get('start', world.names[0])
+        if start not in world.index:
+            raise ValueError('Start room {} is not in the world'.format(start))
+        world.start = world.index[start]
+        del description, entries
+    finally:
+        gc.enable()
+    gc.freeze()
+    return world